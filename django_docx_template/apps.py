@@ -1,6 +1,35 @@
 from django.apps import AppConfig
+from django.core import checks
 
 
 class DjangoDocxTemplateConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "django_docx_template"
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .utils import get_setting, load_data_sources
+
+        # resolve data sources now rather than on the first request, unknown ones
+        # are reported by the check below
+        load_data_sources()
+        checks.register(check_data_sources)
+        if get_setting("preload_templates", False):
+            from .warmup import preload_on_ready
+
+            preload_on_ready()
+
+
+def check_data_sources(app_configs, **kwargs):
+    """Resolve the data sources listed in settings once for all, and report those
+    that can't be imported."""
+    from .utils import load_data_sources
+
+    return [
+        checks.Error(
+            f"Unknown DataSource {class_path}",
+            hint='Check settings.DJANGO_DOCX_TEMPLATES["data_sources"].',
+            id="django_docx_template.E001",
+        )
+        for class_path in load_data_sources()
+    ]
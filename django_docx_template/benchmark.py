@@ -0,0 +1,239 @@
+"""Benchmarks of the merge pipeline, run with the docx_benchmark command.
+
+Synthetic templates are generated for each scenario (number of pages, tags, loop rows
+and images) and merged with BenchmarkDataSource, which builds contexts in memory. Each
+stage of DocxTemplate.merge is timed separately:
+
+* context: DataSource.get_context_data
+* load: reading and parsing the docx file (a template cache miss)
+* clone: copy of the parsed template (a template cache hit)
+* render: context cleaning (converters, images) and docxtpl render
+* save: writing the merged document to memory
+
+Results are a flat dict of median times in seconds, by metric name (for example
+"merge/pages-50/render"), easy to store as JSON and to compare with a baseline.
+"""
+
+from io import BytesIO
+import math
+import os
+import platform
+import statistics
+import struct
+from time import perf_counter
+import zlib
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+import django
+from docx import Document
+from docx.enum.text import WD_BREAK
+
+from . import data_sources
+from .models import DocxTemplate
+
+SCENARIOS = {
+    "small": {"pages": 1, "tags": 10},
+    "pages-50": {"pages": 50, "tags": 10},
+    "tags-1000": {"pages": 1, "tags": 1000},
+    "rows-1000": {"pages": 1, "tags": 10, "rows": 1000},
+    "images-10": {"pages": 1, "tags": 10, "images": 10, "image_size": 256},
+    "images-large": {"pages": 1, "tags": 10, "images": 2, "image_size": 1500},
+}
+
+# DataSource scaling: (number of fields, number of examples per field)
+DATA_SOURCE_SIZES = [(10, 5), (100, 5), (1000, 2)]
+
+STAGES = ("context", "load", "clone", "render", "save")
+
+# paragraphs of static text per page
+LINES_PER_PAGE = 40
+TEXT = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod."
+
+
+def make_png(size: int) -> bytes:
+    """Return a size x size RGB PNG of random pixels (not compressible, like a
+    photo)."""
+
+    def chunk(kind, data):
+        content = kind + data
+        return (
+            struct.pack(">I", len(data))
+            + content
+            + struct.pack(">I", zlib.crc32(content))
+        )
+
+    rows = b"".join(b"\x00" + os.urandom(size * 3) for _ in range(size))
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(rows, 1))
+        + chunk(b"IEND", b"")
+    )
+
+
+def make_template(pages=1, tags=10, rows=0, images=0, **kwargs) -> bytes:
+    """Return the content of a docx template of the given dimensions. Tags are
+    spread over the pages, loop rows fill a table and each image has its own
+    paragraph."""
+    document = Document()
+    tags_per_page = math.ceil(tags / pages)
+    for page in range(pages):
+        first_tag = page * tags_per_page
+        for tag in range(first_tag, min(first_tag + tags_per_page, tags)):
+            document.add_paragraph(f"Field {tag}: {{{{ field_{tag} }}}}")
+        for _ in range(LINES_PER_PAGE):
+            document.add_paragraph(TEXT)
+        if page < pages - 1:
+            document.add_paragraph().add_run().add_break(WD_BREAK.PAGE)
+    if rows:
+        table = document.add_table(rows=3, cols=2)
+        table.cell(0, 0).text = "{%tr for row in rows %}"
+        table.cell(1, 0).text = "{{ row.label }}"
+        table.cell(1, 1).text = "{{ row.value }}"
+        table.cell(2, 0).text = "{%tr endfor %}"
+    for image in range(images):
+        document.add_paragraph(f"{{{{ image_{image} }}}}")
+    buffer = BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+_images = dict()
+
+
+def get_image(size: int) -> bytes:
+    """Return the PNG of a size, generated once: images are served by the image cache
+    after the first merge, like images of a real DataSource."""
+    if size not in _images:
+        _images[size] = make_png(size)
+    return _images[size]
+
+
+class BenchmarkDataSource(data_sources.DataSource):
+    """DataSource building the context of a scenario in memory, without queries. The
+    merge kwargs are the dimensions of the scenario."""
+
+    label = "Benchmark"
+
+    def get_context_data(self, tags=10, rows=0, images=0, image_size=256, **kwargs):
+        context = {f"field_{tag}": f"value {tag}" for tag in range(tags)}
+        context["rows"] = [{"label": f"row {row}", "value": row} for row in range(rows)]
+        for image in range(images):
+            blob = get_image(image_size)
+            context[f"image_{image}"] = data_sources.Image(blob, width=40)
+        return context
+
+
+def time_merge_stages(template, merge_kwargs, repeat=5) -> dict:
+    """Return the median time of each stage of a merge (see STAGES). A first merge,
+    not measured, warms up the caches (compiled templates, images)."""
+    timings = {stage: [] for stage in STAGES}
+    cached = template._load_template(normalize=True)
+    for run in range(repeat + 1):
+        start = perf_counter()
+        context = template.data_source.get_context_data(**merge_kwargs)
+        context_end = perf_counter()
+        template._load_template()
+        load_end = perf_counter()
+        docx_engine = template._load_engine(cached)
+        clone_end = perf_counter()
+        cleaned = template._clean_context(docx_engine, context)
+        docx_engine.render(cleaned)
+        render_end = perf_counter()
+        docx_engine.save(BytesIO())
+        save_end = perf_counter()
+        if run == 0:
+            continue
+        timings["context"].append(context_end - start)
+        timings["load"].append(load_end - context_end)
+        timings["clone"].append(clone_end - load_end)
+        timings["render"].append(render_end - clone_end)
+        timings["save"].append(save_end - render_end)
+    results = {stage: statistics.median(values) for stage, values in timings.items()}
+    results["total"] = sum(results.values())
+    return results
+
+
+def bench_scenario(name, dimensions, repeat=5) -> dict:
+    """Time a merge of the synthetic template of a scenario."""
+    template = DocxTemplate(
+        name=f"Benchmark {name}",
+        docx=SimpleUploadedFile("benchmark.docx", make_template(**dimensions)),
+        data_source_class="django_docx_template.benchmark.BenchmarkDataSource",
+    )
+    return time_merge_stages(template, dimensions, repeat)
+
+
+def bench_data_source(fields, examples, repeat=5) -> dict:
+    """Time get_data_fields and get_all_example_combinations of a DataSource of
+    fields fields having examples examples each."""
+    attributes = {
+        f"field_{i}": data_sources.Field(examples=list(range(examples)))
+        for i in range(fields)
+    }
+    data_source_class = type("ScaledDataSource", (data_sources.DataSource,), attributes)
+    data_source = data_source_class("django_docx_template.benchmark.ScaledDataSource")
+    timings = {"get_data_fields": [], "example_combinations": []}
+    for _ in range(repeat):
+        start = perf_counter()
+        data_source.get_data_fields()
+        fields_end = perf_counter()
+        combinations = data_source.get_all_example_combinations()
+        combinations[combinations.count() - 1]
+        combinations[:20]
+        combinations_end = perf_counter()
+        timings["get_data_fields"].append(fields_end - start)
+        timings["example_combinations"].append(combinations_end - fields_end)
+    return {name: statistics.median(values) for name, values in timings.items()}
+
+
+def run(scenarios=None, repeat=5, data_source_sizes=None) -> dict:
+    """Run the benchmarks and return {metric name: median time in seconds}.
+
+    Parameters
+    ==========
+    * scenarios: dict of scenario name: dimensions, default to SCENARIOS
+    * repeat: number of measured runs of each benchmark
+    * data_source_sizes: list of (fields, examples), default to DATA_SOURCE_SIZES
+    """
+    if scenarios is None:
+        scenarios = SCENARIOS
+    if data_source_sizes is None:
+        data_source_sizes = DATA_SOURCE_SIZES
+    results = dict()
+    for name, dimensions in scenarios.items():
+        for stage, value in bench_scenario(name, dimensions, repeat).items():
+            results[f"merge/{name}/{stage}"] = value
+    for fields, examples in data_source_sizes:
+        size = f"{fields}x{examples}"
+        for operation, value in bench_data_source(fields, examples, repeat).items():
+            results[f"data_source/{size}/{operation}"] = value
+    return results
+
+
+def get_environment() -> dict:
+    """Return the versions the benchmark ran with, stored next to the results."""
+    from docxtpl import __version__ as docxtpl_version
+
+    return {
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "docxtpl": docxtpl_version,
+        "machine": platform.machine(),
+    }
+
+
+def compare(results, baseline, threshold=0.2, min_time=0.001):
+    """Return the regressions of results against baseline, as a list of
+    (metric name, baseline time, new time). A metric regresses when it is more than
+    threshold (a ratio) slower. Metrics faster than min_time seconds in both runs are
+    too noisy to be compared."""
+    regressions = []
+    for name, before in baseline.items():
+        after = results.get(name)
+        if after is None or max(before, after) < min_time:
+            continue
+        if after > before * (1 + threshold):
+            regressions.append((name, before, after))
+    return regressions
@@ -0,0 +1,298 @@
+"""Caches used to avoid repeating work between merges."""
+from collections import OrderedDict
+import copy
+import hashlib
+from io import BytesIO
+import os
+from pathlib import Path
+from pydoc import locate
+import shutil
+import tempfile
+from threading import RLock
+import zipfile
+
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from docx import Document
+
+from .package import normalize_package
+from .utils import get_setting
+
+
+class CachedTemplate:
+    """A parsed docx template. The cached document must stay pristine, so each render
+    works on a clone of it."""
+
+    def __init__(self, document, size, source=None):
+        self.document = document
+        # approximation of the memory used by the entry: uncompressed package size
+        self.size = size
+        # Jinja templates compiled from the parts of the document, see DocxEngine
+        self.compiled = dict()
+        # serialized template whose members are reused by saves, see package.py
+        self.source = source
+        if source is not None:
+            self.size += len(source.content)
+
+    @classmethod
+    def from_bytes(cls, content: bytes, normalize=False) -> "CachedTemplate":
+        """Parse the content of a docx file. With normalize, the template is also
+        serialized once, so that saves of merged documents copy its unchanged members
+        instead of compressing them again (worth it for templates merged many
+        times, see package.normalize_package)."""
+        with zipfile.ZipFile(BytesIO(content)) as package:
+            size = sum(info.file_size for info in package.infolist())
+        document = Document(BytesIO(content))
+        source = None
+        if normalize:
+            source = normalize_package(document, get_setting("compress_level", None))
+        return cls(document, size, source)
+
+    def clone(self):
+        """Return a copy of the parsed document, ready to be rendered. Copying lxml
+        trees is much cheaper than inflating and parsing the file again."""
+        return copy.deepcopy(self.document)
+
+
+class LRUCache:
+    """Least recently used cache, bounded both by a number of entries and by the
+    total size of the entries, given by their size attribute."""
+
+    def __init__(self, max_entries=32, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Return the entry stored for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry) -> None:
+        """Store entry, then evict the least recently used entries until the cache
+        fits its budget. An entry bigger than the whole budget is not stored."""
+        if self.max_entries <= 0 or entry.size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self.current_bytes += entry.size
+            while (
+                len(self._entries) > self.max_entries
+                or self.current_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def get_or_load(self, key, loader):
+        """Return the entry stored for key. On a miss, loader() is called to build it.
+        Loading is done outside the lock, so a slow loader doesn't block others."""
+        entry = self.get(key)
+        if entry is None:
+            entry = loader()
+            self.set(key, entry)
+        return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry.size
+
+
+class TemplateCache(LRUCache):
+    """Cache of parsed templates (CachedTemplate). Keys are tuples starting with the
+    template slug, followed by a version of the file (see
+    DocxTemplate.get_file_version)."""
+
+    def invalidate(self, slug) -> None:
+        """Remove every version of a template."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == slug]:
+                self._remove(key)
+
+
+class ImageCache(LRUCache):
+    """Cache of images (data_sources.ImageAsset), keyed by data_sources.Image."""
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024):
+        super().__init__(max_entries, max_bytes)
+
+
+_template_cache = None
+
+
+def get_template_cache() -> TemplateCache:
+    """Return the cache of parsed templates of this process, configured through
+    settings.DJANGO_DOCX_TEMPLATES["template_cache"]."""
+    global _template_cache
+    if _template_cache is None:
+        _template_cache = TemplateCache(**get_setting("template_cache", {}))
+    return _template_cache
+
+
+_image_cache = None
+
+
+def get_image_cache() -> ImageCache:
+    """Return the cache of images (data_sources.ImageAsset) of this process,
+    configured through settings.DJANGO_DOCX_TEMPLATES["image_cache"]."""
+    global _image_cache
+    if _image_cache is None:
+        _image_cache = ImageCache(**get_setting("image_cache", {}))
+    return _image_cache
+
+
+class DjangoCacheBackend:
+    """Output cache storing merged documents in a Django cache."""
+
+    def __init__(self, alias="default", timeout=None, key_prefix="docx_template"):
+        self.alias = alias
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        """Return the stored document as a file-like object, or None."""
+        content = self.cache.get(f"{self.key_prefix}:{key}")
+        return None if content is None else BytesIO(content)
+
+    def set(self, key, buffer) -> None:
+        self.cache.set(f"{self.key_prefix}:{key}", buffer.read(), self.timeout)
+        buffer.seek(0)
+
+
+class FileSystemBackend:
+    """Output cache storing merged documents as files of a local directory. When the
+    directory grows above max_bytes, least recently used documents are deleted."""
+
+    def __init__(self, location, max_bytes=256 * 1024 * 1024):
+        self.location = Path(location)
+        self.max_bytes = max_bytes
+
+    def get_path(self, key) -> Path:
+        return self.location / f"{key}.docx"
+
+    def get(self, key):
+        """Return the stored document opened in binary mode, or None."""
+        path = self.get_path(key)
+        try:
+            document = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        # the modification time is the last use time, used for eviction
+        os.utime(path)
+        return document
+
+    def set(self, key, buffer) -> None:
+        self.location.mkdir(parents=True, exist_ok=True)
+        path = self.get_path(key)
+        with tempfile.NamedTemporaryFile(dir=self.location, delete=False) as tmp_file:
+            shutil.copyfileobj(buffer, tmp_file)
+        buffer.seek(0)
+        os.replace(tmp_file.name, path)
+        self.evict()
+
+    def evict(self) -> None:
+        """Delete least recently used documents until the directory fits max_bytes."""
+        files = []
+        for path in self.location.glob("*.docx"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _mtime, size, _path in files)
+        for _mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+
+OUTPUT_CACHE_BACKENDS = {
+    "django": DjangoCacheBackend,
+    "filesystem": FileSystemBackend,
+}
+
+
+_output_cache = None
+
+
+def get_output_cache():
+    """Return the cache of merged documents configured through
+    settings.DJANGO_DOCX_TEMPLATES["output_cache"], or None if it is not enabled:
+
+        "output_cache": {"backend": "django", "alias": "default", "timeout": 3600}
+        "output_cache": {"backend": "filesystem", "location": "/var/cache/docx"}
+    """
+    global _output_cache
+    if _output_cache is None:
+        options = dict(get_setting("output_cache", None) or {})
+        if not options:
+            return None
+        backend = options.pop("backend", "django")
+        backend_class = OUTPUT_CACHE_BACKENDS.get(backend) or locate(backend)
+        if backend_class is None:
+            raise ImproperlyConfigured(f"Unknown output cache backend {backend}")
+        _output_cache = backend_class(**options)
+    return _output_cache
+
+
+class LocalMirror:
+    """Read-through copy of template files on local disk, for remote storages. Files
+    are named after their content hash (see DocxTemplate.content_hash), written
+    atomically and evicted least recently used first when the directory grows above
+    max_bytes (see FileSystemBackend)."""
+
+    def __init__(self, location, max_bytes=256 * 1024 * 1024):
+        self.files = FileSystemBackend(location, max_bytes)
+
+    def read(self, field_file, content_hash) -> bytes:
+        """Return the content of field_file, from the local copy when there is one.
+        Otherwise it is downloaded from the storage, and kept if it matches
+        content_hash (a file changed behind the database is never mirrored)."""
+        local_file = self.files.get(content_hash)
+        if local_file is not None:
+            with local_file:
+                return local_file.read()
+        with field_file.open("rb") as remote_file:
+            content = remote_file.read()
+        if hashlib.sha256(content).hexdigest() == content_hash:
+            self.files.set(content_hash, BytesIO(content))
+        return content
+
+
+_local_mirror = None
+
+
+def get_local_mirror():
+    """Return the local mirror of template files configured through
+    settings.DJANGO_DOCX_TEMPLATES["local_mirror"], or None if it is not enabled:
+
+        "local_mirror": {"location": "/var/cache/docx-templates", "max_bytes": 2**30}
+    """
+    global _local_mirror
+    if _local_mirror is None:
+        options = get_setting("local_mirror", None)
+        if not options:
+            return None
+        _local_mirror = LocalMirror(**options)
+    return _local_mirror
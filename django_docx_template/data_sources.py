@@ -1,11 +1,24 @@
 from docxtpl import InlineImage
+from docx.image.image import Image as DocxImage
 from docx.shared import Mm
+import hashlib
 from inspect import getmembers
+from io import BytesIO
 import itertools
+import math
 from pathlib import Path
+import random
+import stat
+from types import MappingProxyType
 
+from asgiref.sync import sync_to_async
 from django.core.exceptions import ImproperlyConfigured
-from django.db.models import F
+from django.core.files import File
+from django.db.models import F, Q
+from django.urls.converters import get_converters
+
+from .cache import get_image_cache
+from .utils import chunked
 
 
 class Field:
@@ -34,11 +47,54 @@ class IntField(Field):
     data_label = "Integer"
 
 
+class RelatedListField(Field):
+    """List of related rows (reverse foreign key or many to many relation), each row
+    being a dict of the given fields. The rows of all the contexts of a merge or of a
+    batch are fetched with one query per field.
+
+    Example:
+        lines = RelatedListField(source="lines", fields=["label", "price"])
+        # rename fields or follow relations with a dict
+        lines = RelatedListField(fields={"label": "label", "unit": "product__unit"})
+
+    In the template: {% for line in lines %}{{ line.label }}{% endfor %}
+    """
+
+    data_type = list
+    data_label = "List"
+
+    def __init__(self, source=None, fields=None, help=None, examples=None):
+        super().__init__(help=help, source=source)
+        # each example is a list of rows
+        self.examples = examples if examples is not None else [[]]
+        if not isinstance(fields, dict):
+            fields = {name: name for name in fields or []}
+        self.fields = fields
+
+
 class ConverterMixin:
     """Interface to find which context element needs to be converted"""
     def convert(self, docx_engine):
         raise NotImplementedError("This method (convert) needs to be implemented")
 
+    def get_cache_key(self):
+        """Return a value (json serializable) identifying the converted content, used
+        to hash contexts for the output cache. Without it, documents are not cached."""
+        raise NotImplementedError("This method (get_cache_key) is not implemented")
+
+
+class ImageAsset:
+    """Bytes of an image and its header parsed by python-docx (format, size in pixels,
+    resolution). Assets are kept in the image cache and shared by all merges."""
+
+    def __init__(self, blob: bytes):
+        self.image = DocxImage.from_blob(blob)
+        self.size = len(blob)
+
+    @property
+    def sha1(self) -> str:
+        return self.image.sha1
+
 
 class Image(ConverterMixin):
     """Define the image to add to the template"""
@@ -48,24 +104,193 @@ class Image(ConverterMixin):
 
         Parameters
         ==========
-        . img_path: file path to a png
+        . img_path: file path to a png, or the image itself as bytes, a file-like
+          object or a Django File (FieldFile of an ImageField for example)
         . width: horizontal size of the image in the docx in millimeters
         . height: vertical size of the image in the docx in millimeters
+
+        Images are loaded once per process and kept in the image cache: by content
+        hash for bytes and file-like objects, by name, modification time and size
+        for paths and storage files (a file replaced in place is loaded again).
         """
-        if not Path(img_path).is_file():
-            raise ValueError("Provided path is not a file")
-        self.img_path = img_path
+        self.img_path = None
+        self.source = img_path
+        self.cache_key = None
+        if isinstance(img_path, (str, Path)):
+            self.img_path = img_path
+            try:
+                file_stat = Path(img_path).stat()
+            except OSError:
+                file_stat = None
+            if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+                raise ValueError("Provided path is not a file")
+            self.cache_key = (
+                "path",
+                str(img_path),
+                file_stat.st_mtime_ns,
+                file_stat.st_size,
+            )
         self.width = Mm(width) if width else None
         self.height = Mm(height) if height else None
 
+    def is_storage_file(self) -> bool:
+        return isinstance(self.source, File) and bool(
+            getattr(self.source, "storage", None)
+        )
+
+    def get_storage_key(self):
+        """Return the image cache key of a storage file: storage, name, modification
+        time and size. None if the storage doesn't know them."""
+        storage = self.source.storage
+        name = self.source.name
+        try:
+            modified = storage.get_modified_time(name).timestamp()
+            size = storage.size(name)
+        except (NotImplementedError, OSError):
+            return None
+        storage_id = f"{type(storage).__module__}.{type(storage).__name__}"
+        return ("storage", storage_id, name, modified, size)
+
+    def read(self) -> bytes:
+        """Return the bytes of the image."""
+        if self.img_path is not None:
+            return Path(self.img_path).read_bytes()
+        if isinstance(self.source, (bytes, bytearray, memoryview)):
+            return bytes(self.source)
+        if self.is_storage_file():
+            with self.source.storage.open(self.source.name, "rb") as image_file:
+                return image_file.read()
+        if hasattr(self.source, "seek"):
+            self.source.seek(0)
+        return self.source.read()
+
+    def __getstate__(self):
+        """Images are pickled to the workers of executors.ProcessExecutor: file-like
+        and memoryview sources, which can't be pickled, are replaced by their
+        bytes. Paths, bytes and storage files are sent as they are."""
+        state = self.__dict__.copy()
+        if not (
+            self.img_path is not None
+            or isinstance(self.source, (bytes, bytearray))
+            or self.is_storage_file()
+        ):
+            state["source"] = self.read()
+        return state
+
+    def get_asset(self) -> ImageAsset:
+        """Return the ImageAsset of this image, from the image cache if possible."""
+        image_cache = get_image_cache()
+        if self.cache_key is None and self.is_storage_file():
+            self.cache_key = self.get_storage_key()
+        if self.cache_key is not None:
+            return image_cache.get_or_load(self.cache_key, self._load_asset)
+        blob = self.read()
+        self.cache_key = ("sha1", hashlib.sha1(blob).hexdigest())
+        return image_cache.get_or_load(self.cache_key, lambda: ImageAsset(blob))
+
+    def _load_asset(self) -> ImageAsset:
+        return ImageAsset(self.read())
+
+    def get_cache_key(self):
+        return [self.get_asset().sha1, self.width, self.height]
+
     def convert(self, docx_engine):
         """Return docx_template equivalent of this image, hydrating with the
-        docx_template that will be merged"""
+        docx_template that will be merged. python-docx adds the image to the document
+        once, whatever the number of occurrences."""
+        blob = self.get_asset().image.blob
         return InlineImage(
-            docx_engine, self.img_path, width=self.width, height=self.height,
+            docx_engine, BytesIO(blob), width=self.width, height=self.height
         )
 
 
+def walk_converters(value, docx_engine):
+    """Return value with every ConverterMixin found in nested dicts, lists and tuples
+    replaced by its converted value, in a single pass. The given containers are never
+    modified: the ones leading to a converter are copied, the others are returned as
+    they are."""
+    if isinstance(value, ConverterMixin):
+        return value.convert(docx_engine)
+    if isinstance(value, dict):
+        return _walk_dict(value, docx_engine)
+    if isinstance(value, (list, tuple)):
+        return _walk_sequence(value, docx_engine)
+    return value
+
+
+def _walk_dict(value: dict, docx_engine) -> dict:
+    converted = None
+    for key, item in value.items():
+        new_item = walk_converters(item, docx_engine)
+        if new_item is not item:
+            if converted is None:
+                converted = dict(value)
+            converted[key] = new_item
+    return value if converted is None else converted
+
+
+def _walk_sequence(value, docx_engine):
+    items = [walk_converters(item, docx_engine) for item in value]
+    if all(new_item is item for new_item, item in zip(items, value)):
+        return value
+    return items if isinstance(value, list) else tuple(items)
+
+
+class ExampleCombinations:
+    """All combinations of the examples of some fields, computed on demand.
+
+    It behaves like a read-only list of dict (len, indexing, slicing and iteration)
+    in the order of itertools.product, without materializing it: item n is decoded
+    from n written in mixed radix, each digit being the index of the example of one
+    field.
+    """
+
+    def __init__(self, fields: dict):
+        self.keys = list(fields.keys())
+        self.examples = [
+            field.examples if isinstance(field.examples, list) else [None]
+            for field in fields.values()
+        ]
+        self._length = math.prod(len(examples) for examples in self.examples)
+
+    def __len__(self):
+        return self._length
+
+    def count(self) -> int:
+        """Number of combinations. Unlike len(), it works above sys.maxsize, it is
+        also what Paginator uses."""
+        return self._length
+
+    def __bool__(self):
+        return self._length > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("Example combination index out of range")
+        values = []
+        # the last field varies the fastest, as in itertools.product
+        for examples in reversed(self.examples):
+            index, digit = divmod(index, len(examples))
+            values.append(examples[digit])
+        return dict(zip(self.keys, reversed(values)))
+
+    def __iter__(self):
+        for instance in itertools.product(*self.examples):
+            yield dict(zip(self.keys, instance))
+
+    def random(self) -> dict:
+        """Return a random combination."""
+        return self[random.randrange(self._length)]
+
+    def sample(self, size: int) -> list:
+        """Return size distinct combinations chosen randomly."""
+        return [self[i] for i in random.sample(range(self._length), size)]
+
+
 # rename as DataViews ? it's more close to class based views than to models
 class DataSource:
     # human readible title or name
@@ -78,10 +303,46 @@ class DataSource:
     model = None
     queryset = None
     fields = None
+    # number of contexts fetched per query by get_context_data_many()
+    context_chunk_size = 500
+    # filters accepted by bulk merges, same format as url_args
+    bulk_filter_args = None
+    # root variables used by the merged template (see DocxTemplate.variables). With
+    # prune_fields, only those fields are fetched. Leave prune_fields off when
+    # get_context_data() builds values from fields the template doesn't name.
+    used_variables = None
+    prune_fields = False
+    # fields collected once per class, see __init_subclass__
+    _data_fields = MappingProxyType({})
+    _queryset_fields = ((), MappingProxyType({}))
+    _related_fields = MappingProxyType({})
 
     def __init__(self, class_path):
         self.class_path = class_path
 
+    def __init_subclass__(cls, **kwargs):
+        """Collect the fields of each subclass once, when it is defined, so merges
+        don't pay for introspection. Fields must therefore be declared in the class
+        body."""
+        super().__init_subclass__(**kwargs)
+        fields = {n: v for n, v in getmembers(cls) if isinstance(v, Field)}
+        cls._data_fields = MappingProxyType({k: fields[k] for k in sorted(fields)})
+        simple_fields = []
+        expression_fields = dict()
+        related_fields = dict()
+        for field_name, field_value in cls._data_fields.items():
+            if isinstance(field_value, RelatedListField):
+                related_fields[field_name] = field_value
+            elif field_value.source:
+                expression_fields[field_name] = F(field_value.source)
+            else:
+                simple_fields.append(field_name)
+        cls._queryset_fields = (
+            tuple(simple_fields),
+            MappingProxyType(expression_fields),
+        )
+        cls._related_fields = MappingProxyType(related_fields)
+
     def get_label(self):
         if not self.label:
             raise ImproperlyConfigured("DataSource.label is not set.")
@@ -89,7 +350,8 @@ class DataSource:
 
     def filter_url_args(self, url_kwargs):
         """Return only data_source parameters from a list of parameters"""
-        return {n: v for n, v in url_kwargs.items() if n in self.url_args}
+        url_args = self.url_args or {}
+        return {n: v for n, v in url_kwargs.items() if n in url_args}
 
     def get_url(self):
         """Keys are the required arguments to get all context. For example,
@@ -105,14 +367,14 @@ class DataSource:
         }
         Would retur: "<int:pk>/<slug:label>"
         """
-        parts = [f"<{tags_type}:{name}>" for name, tags_type in self.url_args.items()]
+        url_args = self.url_args or {}
+        parts = [f"<{tags_type}:{name}>" for name, tags_type in url_args.items()]
         return "/".join(parts)
 
     def get_data_fields(self):
-        """Return all fields of the datasource ordered by name.
-        DataSource fields must inherit from Field class."""
-        fields = {n: v for n, v in getmembers(self) if isinstance(v, Field)}
-        return {k: fields[k] for k in sorted(fields.keys())}
+        """Return all fields of the datasource ordered by name, as a read-only
+        mapping. DataSource fields must inherit from Field class."""
+        return self._data_fields
 
     def get_data_definition(self) -> dict():
         """Return a list of all items that is available in this datasource. It's used by
@@ -143,11 +405,17 @@ class DataSource:
                     "name": field_name,
                     "type": field_value.data_label,
                     "help": field_value.help,
-                    "examples_values": ", ".join(field_value.examples),
+                    "examples_values": ", ".join(map(str, field_value.examples)),
                 }
             )
         return definition
 
+    def convert_context(self, context, docx_engine):
+        """Return context with every converter (see ConverterMixin) replaced by its
+        converted value, wherever it is. context itself is left untouched, so a
+        context (or part of it) can be shared by several merges."""
+        return walk_converters(context, docx_engine)
+
     def get_queryset(self):
         """Return an initialized Queryset"""
         if self.queryset is not None:
@@ -172,15 +440,44 @@ class DataSource:
 
     def get_queryset_fields(self):
         """Return fields listed according to DataField listed in the DataSource. Source
-        property is used if defined else it's the field name."""
-        simple_fields = []
-        expression_fields = dict()
-        for field_name, field_value in self.get_data_fields().items():
-            if field_value.source:
-                expression_fields[field_name] = F(field_value.source)
-            else:
-                simple_fields.append(field_name)
-        return simple_fields, expression_fields
+        property is used if defined else it's the field name.
+
+        Return a tuple of names and a read-only mapping of F() expressions, both
+        computed once per class. When used_variables is set, fields the template
+        doesn't use are left out (see prune_fields), which also avoids the joins of
+        their source."""
+        if not self.is_pruned():
+            return self._queryset_fields
+        used_variables = frozenset(self.used_variables)
+        pruned = self.__dict__.get("_pruned_queryset_fields")
+        if pruned is None or pruned[0] != used_variables:
+            # images are lifted to the root of the context (see DocxTemplate)
+            used = used_variables | {"images"}
+            fields, expressions = self._queryset_fields
+            pruned = (
+                used_variables,
+                (
+                    tuple(name for name in fields if name in used),
+                    MappingProxyType(
+                        {n: e for n, e in expressions.items() if n in used}
+                    ),
+                ),
+            )
+            self._pruned_queryset_fields = pruned
+        return pruned[1]
+
+    def is_pruned(self) -> bool:
+        """Return True if fields unused by the template are left out of queries."""
+        return self.prune_fields and self.used_variables is not None
+
+    def get_values_arguments(self):
+        """Return the fields and expressions given to QuerySet.values(). The primary
+        key is added as _pk to load related lists, and when the template uses no
+        field at all: values() without arguments would fetch every column."""
+        fields, expressions = self.get_queryset_fields()
+        if self.get_related_fields() or not (fields or expressions):
+            expressions = {**expressions, "_pk": F("pk")}
+        return fields, expressions
 
     def get_context_data(self, **keys: dict()) -> dict():
         """
@@ -189,28 +486,167 @@ class DataSource:
         `QuerySet` in which case `QuerySet` specific behavior will be enabled.
         """
         queryset = self.get_filtered_queryset(**keys)
-        fields, expression = self.get_queryset_fields()
+        fields, expression = self.get_values_arguments()
         queryset = queryset.values(*fields, **expression)
         # TODO force dict ?
-        return queryset.first()
+        context = queryset.first()
+        if context is not None:
+            pk = context.pop("_pk", None)
+            if self.get_related_fields():
+                self.fill_related_lists({pk: context})
+        return context
+
+    async def aget_context_data(self, **keys: dict()) -> dict():
+        """Async version of get_context_data(), using the async ORM. When
+        get_context_data() is overridden but not this method, it runs in a thread."""
+        if type(self).get_context_data is not DataSource.get_context_data:
+            return await sync_to_async(self.get_context_data)(**keys)
+        queryset = self.get_filtered_queryset(**keys)
+        fields, expression = self.get_values_arguments()
+        queryset = queryset.values(*fields, **expression)
+        context = await queryset.afirst()
+        if context is not None:
+            pk = context.pop("_pk", None)
+            if self.get_related_fields():
+                await sync_to_async(self.fill_related_lists)({pk: context})
+        return context
+
+    def get_related_fields(self):
+        """Return the RelatedListField of the DataSource used by the template."""
+        if not self.is_pruned():
+            return self._related_fields
+        related = self._related_fields.items()
+        return {n: f for n, f in related if n in self.used_variables}
+
+    def fill_related_lists(self, contexts) -> None:
+        """Set the related lists (see RelatedListField) of contexts, a dict of
+        contexts by primary key. Each field costs one query, whatever the number of
+        contexts and of related rows."""
+        for name, field in self.get_related_fields().items():
+            source = field.source or name
+            for context in contexts.values():
+                context[name] = []
+            lookups = [f"{source}__{path}" for path in field.fields.values()]
+            queryset = self.get_queryset().filter(pk__in=list(contexts))
+            queryset = queryset.order_by("pk", source)
+            rows = queryset.values_list("pk", f"{source}__pk", *lookups)
+            for pk, related_pk, *values in rows:
+                if related_pk is not None:
+                    contexts[pk][name].append(dict(zip(field.fields, values)))
+
+    def get_last_modified(self, **keys):
+        """Return the datetime of the last modification of the data of keys, or None
+        if it is unknown. When it is known, merge views answer conditional requests
+        (If-Modified-Since) without fetching the context, else they compare ETags
+        built from the context (see DocxTemplate.get_etag).
+
+        Example: return self.get_filtered_queryset(**keys).values_list(
+            "updated_at", flat=True).first()
+        """
+        return None
+
+    def get_context_key(self, url_kwargs) -> tuple:
+        """Return the values of the url arguments, used to match a context row with
+        the url_kwargs it was fetched for."""
+        return tuple(url_kwargs[name] for name in self.url_args)
+
+    def get_many_queryset(self, url_kwargs_list):
+        """Return the queryset of all rows matching any item of url_kwargs_list."""
+        names = list(self.url_args)
+        queryset = self.get_queryset()
+        if len(names) == 1:
+            values = [url_kwargs[names[0]] for url_kwargs in url_kwargs_list]
+            return queryset.filter(**{f"{names[0]}__in": values})
+        condition = Q()
+        for url_kwargs in url_kwargs_list:
+            condition |= Q(**self.filter_url_args(url_kwargs))
+        return queryset.filter(condition)
+
+    def get_context_data_many(self, url_kwargs_list, chunk_size=None):
+        """Yield (url_kwargs, context) for each item of url_kwargs_list, in the same
+        order. Contexts are fetched with one query per chunk instead of one query per
+        item. url_kwargs values must have the type of the database values (as returned
+        by url converters), a missing row gives a None context like
+        get_context_data().
+
+        When get_context_data() is overridden but not this method, contexts are
+        loaded one by one with get_context_data().
+        """
+        if type(self).get_context_data is not DataSource.get_context_data:
+            for url_kwargs in url_kwargs_list:
+                yield url_kwargs, self.get_context_data(**url_kwargs)
+            return
+        fields, expressions = self.get_values_arguments()
+        key_expressions = {f"_key_{name}": F(name) for name in self.url_args}
+        related = self.get_related_fields()
+        for chunk in chunked(url_kwargs_list, chunk_size or self.context_chunk_size):
+            queryset = self.get_many_queryset(chunk)
+            queryset = queryset.values(*fields, **expressions, **key_expressions)
+            contexts = dict()
+            for row in queryset:
+                key = tuple(row.pop(name) for name in key_expressions)
+                contexts.setdefault(key, row)
+            by_pk = {context.pop("_pk", None): context for context in contexts.values()}
+            if related:
+                self.fill_related_lists(by_pk)
+            for url_kwargs in chunk:
+                yield url_kwargs, contexts.get(self.get_context_key(url_kwargs))
+
+    def get_bulk_url_kwargs(self, query_dict):
+        """Return the list of url kwargs of a bulk merge, read from a QueryDict.
+
+        Either every url argument is given, possibly repeated (?pk=1&pk=2&pk=3) and
+        items are built by position, or the query string holds filters listed in
+        bulk_filter_args (?category=3) and all matching rows are merged.
+
+        Raise ValueError if values are invalid, if url arguments aren't repeated the
+        same number of times or if nothing can be merged.
+        """
+        if all(name in query_dict for name in self.url_args):
+            columns = []
+            for name, tags_type in self.url_args.items():
+                to_python = self.get_bulk_converter(tags_type).to_python
+                columns.append([to_python(v) for v in query_dict.getlist(name)])
+            if len({len(column) for column in columns}) > 1:
+                raise ValueError(
+                    "Url arguments must be repeated the same number of times."
+                )
+            return [dict(zip(self.url_args, values)) for values in zip(*columns)]
+        filters = {
+            name: self.get_bulk_converter(tags_type).to_python(query_dict[name])
+            for name, tags_type in (self.bulk_filter_args or {}).items()
+            if name in query_dict
+        }
+        if not filters:
+            raise ValueError("Bulk merge requires url arguments or filters.")
+        queryset = self.get_queryset().filter(**filters)
+        return queryset.values(*self.url_args).iterator()
+
+    def to_python_url_kwargs(self, url_kwargs) -> dict:
+        """Return url_kwargs with the string values of url arguments converted by
+        their url converter, as in the kwargs of a resolved url. Kwargs stored as
+        JSON (see models.MergeJob) get back the type of the database values."""
+        url_kwargs = dict(url_kwargs)
+        for name, tags_type in self.url_args.items():
+            if isinstance(url_kwargs.get(name), str):
+                to_python = self.get_bulk_converter(tags_type).to_python
+                url_kwargs[name] = to_python(url_kwargs[name])
+        return url_kwargs
+
+    @staticmethod
+    def get_bulk_converter(tags_type):
+        """Return the url converter of tags_type, raise ValueError if it is
+        unknown."""
+        try:
+            return get_converters()[tags_type]
+        except KeyError:
+            raise ValueError(f"Unknown url argument type {tags_type}.")
 
     def get_example(self, example_number):
         """Return a specific example from all possible combinations."""
         combinations = self.get_all_example_combinations()
         return combinations[example_number]
 
-    def get_all_example_combinations(self):
-        """Generate all examples combinations possible"""
-        # return Union(list[list[Any]]|list[Any])
-        fields = self.get_data_fields()
-        examples = list()
-        for _name, field in fields.items():
-            if isinstance(field.examples, list):
-                examples.append(field.examples)
-            else:
-                examples.append([None])
-        keys = self.get_data_fields().keys()
-        combinations = list()
-        for instance in itertools.product(*examples):
-            combinations.append(dict(zip(keys, instance)))
-        return combinations
+    def get_all_example_combinations(self) -> ExampleCombinations:
+        """Return all examples combinations possible, computed lazily"""
+        return ExampleCombinations(self.get_data_fields())
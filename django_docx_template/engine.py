@@ -0,0 +1,267 @@
+"""Docx rendering engine: docxtpl.DocxTemplate reusing compiled Jinja templates."""
+from functools import partial
+from pydoc import locate
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from docxtpl import DocxTemplate
+from jinja2 import Environment, TemplateError, meta
+
+from .package import write_package
+from .utils import get_setting
+
+
+_jinja_env = None
+
+
+def get_jinja_env() -> Environment:
+    """Return the Jinja environment of this process, built once from
+    settings.DJANGO_DOCX_TEMPLATES:
+
+        # dotted path to a callable returning a jinja2.Environment
+        "jinja_env": "my_app.docx.get_environment",
+        # filters added to the environment, by name
+        "jinja_filters": {"money": "my_app.docx.format_money"},
+    """
+    global _jinja_env
+    if _jinja_env is None:
+        factory = get_setting("jinja_env", None)
+        env = locate(factory)() if factory else Environment()
+        for name, filter_path in get_setting("jinja_filters", {}).items():
+            jinja_filter = locate(filter_path)
+            if jinja_filter is None:
+                raise ImproperlyConfigured(f"Unknown jinja filter {filter_path}")
+            env.filters[name] = jinja_filter
+        _jinja_env = env
+    return _jinja_env
+
+
+_autoescape_envs = dict()
+
+
+def get_autoescape_env(jinja_env) -> Environment:
+    """Return an overlay of jinja_env escaping variables, created once per
+    environment so the templates compiled with it are reused."""
+    overlay = _autoescape_envs.get(jinja_env)
+    if overlay is None:
+        overlay = jinja_env.overlay(autoescape=True)
+        _autoescape_envs[jinja_env] = overlay
+    return overlay
+
+
+class DocxEngine(DocxTemplate):
+    """docxtpl.DocxTemplate compiling the XML of each part only once.
+
+    docxtpl patches the XML of every part and compiles it as a Jinja template on each
+    render. Here compiled templates are stored in `compiled`, a dict shared by all
+    the engines rendering the same version of a template (see cache.CachedTemplate),
+    so a render only executes them.
+
+    Headers, footers, footnotes and core properties without any tag are recorded in
+    `compiled` with a None template: renders leave them as they are in the template
+    instead of serializing, rendering and parsing them again.
+    """
+
+    FOOTNOTES_CONTENT_TYPE = (
+        "application/vnd.openxmlformats-officedocument"
+        ".wordprocessingml.footnotes+xml"
+    )
+    PROPERTIES = ("author", "comments", "identifier", "language", "subject", "title")
+    # Jinja delimiters, and the escaped delimiters render_compiled unescapes
+    TAG_RE = re.compile(r"\{[{%#]|\{_[{%]|[}%]_\}")
+
+    def __init__(self, template_file, compiled=None, source=None):
+        super().__init__(template_file)
+        self.compiled = compiled if compiled is not None else dict()
+        # package.SourcePackage of the template, its unchanged members are copied
+        # by save()
+        self.source = source
+
+    def render(self, context, jinja_env=None, autoescape=False) -> None:
+        """Render context, with jinja_env or the environment of get_jinja_env(). With
+        autoescape, an overlay of the environment is used instead of switching the
+        autoescape of a shared environment like docxtpl does."""
+        jinja_env = jinja_env or get_jinja_env()
+        if autoescape and not jinja_env.autoescape:
+            jinja_env = get_autoescape_env(jinja_env)
+        super().render(context, jinja_env)
+
+    def save(self, filename, *args, **kwargs) -> None:
+        """Save the rendered document. Members left unchanged by the render are
+        copied from the source package without being compressed again, others are
+        compressed with settings.DJANGO_DOCX_TEMPLATES["compress_level"] (0 to 9,
+        default to 6)."""
+        if self.source is None or not self.is_rendered:
+            return super().save(filename, *args, **kwargs)
+        self.pre_processing()
+        compresslevel = get_setting("compress_level", None)
+        write_package(filename, self.docx.part.package, self.source, compresslevel)
+        self.post_processing(filename)
+        self.is_saved = True
+
+    def get_env_compiled(self, jinja_env=None) -> dict:
+        """Return the compiled templates of jinja_env, by part."""
+        return self.compiled.setdefault(jinja_env or get_jinja_env(), dict())
+
+    def get_compiled(self, key, get_xml, jinja_env, skip_static=False):
+        """Return the compiled template of a part and its encoding, get_xml() returns
+        the XML of the part and is only called on the first render. With skip_static,
+        the template of a part without tags is None."""
+        env_compiled = self.get_env_compiled(jinja_env)
+        compiled = env_compiled.get(key)
+        if compiled is None:
+            src_xml = get_xml()
+            encoding = self.get_headers_footers_encoding(src_xml)
+            src_xml = self.patch_xml(src_xml)
+            if skip_static and not self.TAG_RE.search(src_xml):
+                compiled = (None, encoding)
+            else:
+                src_xml = self.prepare_xml(src_xml)
+                try:
+                    template = (jinja_env or get_jinja_env()).from_string(src_xml)
+                except TemplateError as exc:
+                    self.add_docx_context(exc, src_xml)
+                    raise
+                compiled = (template, encoding)
+            env_compiled[key] = compiled
+        return compiled
+
+    @staticmethod
+    def prepare_xml(src_xml) -> str:
+        """Same preparation as docxtpl render_xml_part, on patched XML."""
+        return re.sub(r"<w:p([ >])", r"\n<w:p\1", src_xml)
+
+    @staticmethod
+    def add_docx_context(exc, src_xml) -> None:
+        """Set the docx_context attribute of a TemplateError to the text of the
+        lines of src_xml around the error, as docxtpl render_xml_part does."""
+        if getattr(exc, "lineno", None) is not None:
+            line_number = max(exc.lineno - 4, 0)
+            lines = src_xml.splitlines()[line_number : line_number + 7]
+            exc.docx_context = [re.sub(r"<[^>]+>", "", line) for line in lines]
+
+    def render_compiled(self, template, part, context, get_xml) -> str:
+        """Same as docxtpl render_xml_part, with an already compiled template.
+
+        The source of the template is only needed to describe a TemplateError, it is
+        then read again with get_xml().
+        """
+        self.current_rendering_part = part
+        try:
+            dst_xml = template.render(context)
+        except TemplateError as exc:
+            self.add_docx_context(exc, self.prepare_xml(self.patch_xml(get_xml())))
+            raise
+        dst_xml = re.sub(r"\n<w:p([ >])", r"<w:p\1", dst_xml)
+        dst_xml = (
+            dst_xml.replace("{_{", "{{")
+            .replace("}_}", "}}")
+            .replace("{_%", "{%")
+            .replace("%_}", "%}")
+        )
+        return self.resolve_listing(dst_xml)
+
+    def build_xml(self, context, jinja_env=None):
+        template, _encoding = self.get_compiled("body", self.get_xml, jinja_env)
+        return self.render_compiled(template, self.docx._part, context, self.get_xml)
+
+    def build_headers_footers_xml(self, context, uri, jinja_env=None):
+        for relKey, part, template, encoding in self.get_rendered_headers_footers(
+            uri, jinja_env
+        ):
+            get_xml = partial(self.get_part_xml, part)
+            xml = self.render_compiled(template, part, context, get_xml)
+            yield relKey, xml.encode(encoding)
+
+    def get_rendered_headers_footers(self, uri, jinja_env=None):
+        """Yield (relKey, part, template, encoding) of the headers or footers of uri
+        which have tags. docxtpl get_headers_footers reads the blob of every part,
+        which serializes it: parts already known to be static are skipped before."""
+        env_compiled = self.get_env_compiled(jinja_env)
+        for relKey, rel in self.docx._part.rels.items():
+            if rel.reltype != uri:
+                continue
+            part = rel.target_part
+            compiled = env_compiled.get(str(part.partname))
+            if compiled is None:
+                if not part.blob:
+                    continue
+                compiled = self.get_headers_footers_compiled(part, jinja_env)
+            template, encoding = compiled
+            if template is not None:
+                yield relKey, part, template, encoding
+
+    def get_headers_footers_compiled(self, part, jinja_env=None):
+        get_xml = partial(self.get_part_xml, part)
+        return self.get_compiled(str(part.partname), get_xml, jinja_env, True)
+
+    def render_footnotes(self, context, jinja_env=None) -> None:
+        for part in self.get_footnotes():
+            template, _encoding = self.get_footnotes_compiled(part, jinja_env)
+            if template is None:
+                continue
+            get_xml = partial(self.get_blob_xml, part)
+            xml = self.render_compiled(template, part, context, get_xml)
+            part._blob = xml.encode("utf-8")
+
+    def get_footnotes_compiled(self, part, jinja_env=None):
+        get_xml = partial(self.get_blob_xml, part)
+        return self.get_compiled(str(part.partname), get_xml, jinja_env, True)
+
+    def get_footnotes(self):
+        for part in self.docx.part.package.parts:
+            if part.content_type == self.FOOTNOTES_CONTENT_TYPE:
+                yield part
+
+    @staticmethod
+    def get_blob_xml(part) -> str:
+        blob = part.blob
+        return blob.decode("utf-8") if isinstance(blob, bytes) else blob
+
+    def render_properties(self, context, jinja_env=None) -> None:
+        for prop in self.PROPERTIES:
+            template = self.get_property_compiled(prop, jinja_env)
+            if template is not None:
+                setattr(self.docx.core_properties, prop, template.render(context))
+
+    def get_property_compiled(self, prop, jinja_env=None):
+        """Return the compiled template of a core property, None if it has no
+        tags."""
+        key = f"property:{prop}"
+        env_compiled = self.get_env_compiled(jinja_env)
+        if key not in env_compiled:
+            initial = getattr(self.docx.core_properties, prop)
+            template = None
+            if self.TAG_RE.search(initial):
+                template = (jinja_env or get_jinja_env()).from_string(initial)
+            env_compiled[key] = template
+        return env_compiled[key]
+
+    def compile(self, jinja_env=None) -> None:
+        """Compile the templates of every part without rendering, so the first render
+        of the template only executes them."""
+        self.get_compiled("body", self.get_xml, jinja_env)
+        for uri in (self.HEADER_URI, self.FOOTER_URI):
+            for _rel_key, part in self.get_headers_footers(uri):
+                self.get_headers_footers_compiled(part, jinja_env)
+        for part in self.get_footnotes():
+            self.get_footnotes_compiled(part, jinja_env)
+        for prop in self.PROPERTIES:
+            self.get_property_compiled(prop, jinja_env)
+
+    def get_template_variables(self, jinja_env=None) -> set:
+        """Return the names of the root variables used by the template, in the body,
+        headers, footers, footnotes and core properties."""
+        sources = [self.get_xml()]
+        for uri in (self.HEADER_URI, self.FOOTER_URI):
+            for _rel_key, part in self.get_headers_footers(uri):
+                sources.append(self.get_part_xml(part))
+        sources.extend(self.get_blob_xml(part) for part in self.get_footnotes())
+        sources = [self.patch_xml(source) for source in sources]
+        for prop in self.PROPERTIES:
+            sources.append(getattr(self.docx.core_properties, prop) or "")
+        jinja_env = jinja_env or get_jinja_env()
+        variables = set()
+        for source in sources:
+            variables |= meta.find_undeclared_variables(jinja_env.parse(source))
+        return variables
@@ -0,0 +1,240 @@
+"""Executors rendering the documents of batch merges.
+
+The executor is selected with settings.DJANGO_DOCX_TEMPLATES["merge_executor"]:
+
+    "merge_executor": {
+        # "serial" (default), "thread", "process" or a dotted path
+        "backend": "process",
+        "max_workers": 4,  # default to the number of CPUs
+        "max_in_flight": 8,  # documents submitted but not yet consumed
+    }
+
+Rendering holds the GIL, so only the process executor spreads a batch over several
+cores. Each worker process keeps its own template cache and sends back the bytes of
+finished documents.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+import multiprocessing
+import os
+from pydoc import locate
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .cache import get_template_cache
+from .utils import get_setting
+
+
+class SerialExecutor:
+    """Render documents one by one in the current thread."""
+
+    def __init__(self, **options):
+        self.options = options
+
+    def render(self, template, items):
+        """Merge template with each context of items, an iterable of (key, context).
+        Yield (key, file object) in the same order, the file is None for a None
+        context."""
+        cached = template._get_cached_template()
+        for key, context in items:
+            if context is None:
+                yield key, None
+            else:
+                yield key, template._merge(context=context, cached=cached)
+
+    def shutdown(self) -> None:
+        pass
+
+
+class PoolExecutor(SerialExecutor):
+    """Base class of executors rendering documents in a pool of workers.
+
+    At most max_in_flight documents are submitted and not yet consumed, so a slow
+    consumer (a streamed response for example) doesn't make finished documents pile
+    up in memory.
+    """
+
+    def __init__(self, max_workers=None, max_in_flight=None, **options):
+        super().__init__(**options)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or 2 * self.max_workers
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = self.create_pool()
+        return self._pool
+
+    def create_pool(self):
+        raise NotImplementedError("This method (create_pool) needs to be implemented")
+
+    def prepare(self, template):
+        """Return what submit() needs to render documents of template, computed once
+        per batch."""
+        return template._get_cached_template()
+
+    def submit(self, template, context, prepared):
+        """Start rendering a document, return a Future."""
+        raise NotImplementedError("This method (submit) needs to be implemented")
+
+    def render(self, template, items):
+        prepared = self.prepare(template)
+        pending = deque()
+        for key, context in items:
+            future = None
+            if context is not None:
+                future = self.submit(template, context, prepared)
+            pending.append((key, future))
+            if len(pending) >= self.max_in_flight:
+                yield self._result(*pending.popleft())
+        while pending:
+            yield self._result(*pending.popleft())
+
+    def _result(self, key, future):
+        return key, None if future is None else future.result()
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+class ThreadExecutor(PoolExecutor):
+    """Render documents in a pool of threads. It only helps when the DataSource or
+    converters wait for I/O, rendering itself holds the GIL."""
+
+    def create_pool(self):
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def submit(self, template, context, prepared):
+        return self.pool.submit(template._merge, context=context, cached=prepared)
+
+
+_in_worker = False
+
+
+def in_worker() -> bool:
+    """Whether this process is a worker of ProcessExecutor."""
+    return _in_worker
+
+
+def init_worker() -> None:
+    """Initialize Django in worker processes started with spawn or forkserver."""
+    global _in_worker
+    from django.apps import apps
+
+    # set before django.setup(), so the app doesn't preload every template
+    _in_worker = True
+    if not apps.ready:
+        import django
+
+        django.setup()
+
+
+def render_in_worker(
+    slug, docx_name, content_hash, data_source_class, version, context
+) -> bytes:
+    """Merge a document in a worker process. The template is loaded through the
+    template cache of the worker, without any database query."""
+    from .models import DocxTemplate
+
+    template = DocxTemplate(
+        slug=slug,
+        docx=docx_name,
+        content_hash=content_hash,
+        data_source_class=data_source_class,
+    )
+    loader = partial(template._load_template, normalize=True)
+    cached = get_template_cache().get_or_load((slug, version), loader)
+    with template._merge(context=context, cached=cached) as document:
+        return document.read()
+
+
+class ProcessExecutor(PoolExecutor):
+    """Render documents in a pool of processes.
+
+    Contexts are pickled to the workers, so they must only hold picklable values
+    (file-like sources of data_sources.Image are sent as bytes).
+    Templates whose file is not saved in the storage yet are rendered in the current
+    process.
+    """
+
+    def __init__(self, start_method=None, **options):
+        super().__init__(**options)
+        self.start_method = start_method
+
+    def create_pool(self):
+        mp_context = None
+        if self.start_method:
+            mp_context = multiprocessing.get_context(self.start_method)
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=mp_context,
+            initializer=init_worker,
+        )
+
+    def render(self, template, items):
+        if not (template.slug and template.docx._committed):
+            return SerialExecutor.render(self, template, items)
+        return super().render(template, items)
+
+    def prepare(self, template):
+        return template.get_file_version()
+
+    def submit(self, template, context, prepared):
+        return self.pool.submit(
+            render_in_worker,
+            template.slug,
+            template.docx.name,
+            template.content_hash,
+            template.data_source_class,
+            prepared,
+            context,
+        )
+
+    def _result(self, key, future):
+        return key, None if future is None else BytesIO(future.result())
+
+
+EXECUTORS = {
+    "serial": SerialExecutor,
+    "thread": ThreadExecutor,
+    "process": ProcessExecutor,
+}
+
+
+def build_executor(backend="serial", **options):
+    """Return a new executor. backend is a name of EXECUTORS or a dotted path."""
+    executor_class = EXECUTORS.get(backend) or locate(backend)
+    if executor_class is None:
+        raise ImproperlyConfigured(f"Unknown merge executor {backend}")
+    return executor_class(**options)
+
+
+_merge_executor = None
+_render_executor = None
+
+
+def get_merge_executor():
+    """Return the executor of this process, configured through
+    settings.DJANGO_DOCX_TEMPLATES["merge_executor"]."""
+    global _merge_executor
+    if _merge_executor is None:
+        _merge_executor = build_executor(**get_setting("merge_executor", {}))
+    return _merge_executor
+
+
+def get_render_executor() -> ThreadPoolExecutor:
+    """Return the pool of threads used by async merges to render documents without
+    blocking the event loop. Its size is set with
+    settings.DJANGO_DOCX_TEMPLATES["async_render_workers"]."""
+    global _render_executor
+    if _render_executor is None:
+        max_workers = get_setting("async_render_workers", None)
+        _render_executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="docx_render"
+        )
+    return _render_executor
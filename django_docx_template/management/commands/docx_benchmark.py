@@ -0,0 +1,73 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_docx_template import benchmark
+from django_docx_template.models import DocxTemplate
+
+
+class Command(BaseCommand):
+    help = (
+        "Time each stage of the merge pipeline on synthetic templates, optionally "
+        "compared with a baseline to detect regressions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scenario",
+            action="append",
+            choices=sorted(benchmark.SCENARIOS),
+            help="Scenario to run (repeatable), default to all of them.",
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--template",
+            help="Also benchmark a saved template, by slug (with --kwargs).",
+        )
+        parser.add_argument(
+            "--kwargs",
+            default="{}",
+            help='Merge kwargs of --template, as JSON (for example {"pk": 1}).',
+        )
+        parser.add_argument("--output", help="Write the results to a JSON file.")
+        parser.add_argument("--compare", help="JSON file of baseline results.")
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=0.2,
+            help="Slowdown ratio reported as a regression (default 0.2, 20%%).",
+        )
+
+    def handle(self, *args, **options):
+        scenarios = benchmark.SCENARIOS
+        if options["scenario"]:
+            scenarios = {name: scenarios[name] for name in options["scenario"]}
+        results = benchmark.run(scenarios=scenarios, repeat=options["repeat"])
+        if options["template"]:
+            template = DocxTemplate.objects.get(slug=options["template"])
+            merge_kwargs = json.loads(options["kwargs"])
+            timings = benchmark.time_merge_stages(
+                template, merge_kwargs, options["repeat"]
+            )
+            for stage, value in timings.items():
+                results[f"template/{template.slug}/{stage}"] = value
+
+        for name, value in results.items():
+            self.stdout.write(f"{name:<50} {value * 1000:10.3f} ms")
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                data = {"environment": benchmark.get_environment(), "results": results}
+                json.dump(data, output, indent=2)
+
+        if options["compare"]:
+            with open(options["compare"]) as baseline_file:
+                baseline = json.load(baseline_file)["results"]
+            regressions = benchmark.compare(
+                results, baseline, threshold=options["threshold"]
+            )
+            for name, before, after in regressions:
+                self.stdout.write(
+                    f"REGRESSION {name}: {before * 1000:.3f} ms -> {after * 1000:.3f} ms"
+                )
+            if regressions:
+                raise CommandError(f"{len(regressions)} benchmark(s) regressed.")
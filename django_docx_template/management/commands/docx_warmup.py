@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from django_docx_template.warmup import preload
+
+
+class Command(BaseCommand):
+    help = (
+        "Load, parse and compile templates in the template cache, and report the "
+        "cost of each one. Run it before forking workers to share the memory."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("slugs", nargs="*", help="Templates, default to all.")
+        parser.add_argument(
+            "--no-memory",
+            action="store_true",
+            help="Don't measure memory, tracing allocations slows the warm-up.",
+        )
+
+    def handle(self, *args, slugs=None, no_memory=False, **options):
+        reports = preload(slugs, measure_memory=not no_memory)
+        for report in reports:
+            line = f"{report['slug']:<40} {report['seconds'] * 1000:10.1f} ms"
+            if report["memory"] is not None:
+                line += f" {report['memory'] / 1024:10.1f} KiB"
+            if report["error"]:
+                line += f"  ERROR {report['error']}"
+            self.stdout.write(line)
+        total_seconds = sum(report["seconds"] for report in reports)
+        total = f"{len(reports)} template(s) in {total_seconds * 1000:.1f} ms"
+        if not no_memory:
+            total_memory = sum(report["memory"] for report in reports)
+            total += f", {total_memory / 1024 / 1024:.1f} MiB"
+        self.stdout.write(total)
@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from django_docx_template.models import MergeJob
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background merges (MergeJob) until stopped. Start as many workers as "
+        "needed, each job is claimed by a single worker. Expired jobs and their "
+        "result are deleted while the queue is empty."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit when no job is pending instead of waiting for new jobs.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=1.0,
+            help="Seconds to wait before polling again when no job is pending.",
+        )
+        parser.add_argument(
+            "--max-jobs",
+            type=int,
+            default=None,
+            help="Exit after running this number of jobs.",
+        )
+        parser.add_argument(
+            "--cleanup-interval",
+            type=float,
+            default=3600.0,
+            help="Seconds between deletions of expired jobs, 0 to never delete them.",
+        )
+
+    def handle(
+        self,
+        *args,
+        once=False,
+        sleep=1.0,
+        max_jobs=None,
+        cleanup_interval=3600.0,
+        **options,
+    ):
+        done = 0
+        cleaned_at = None
+        while max_jobs is None or done < max_jobs:
+            close_old_connections()
+            job = MergeJob.claim()
+            if job is None:
+                if cleanup_interval and (
+                    cleaned_at is None or time.monotonic() - cleaned_at > cleanup_interval
+                ):
+                    MergeJob.delete_expired()
+                    cleaned_at = time.monotonic()
+                if once:
+                    break
+                time.sleep(sleep)
+                continue
+            job.run()
+            done += 1
+            self.stdout.write(f"{job.pk} {job.template_id}: {job.status}")
+        return None
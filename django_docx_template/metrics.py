@@ -0,0 +1,136 @@
+"""Timings of the phases of a merge.
+
+Metrics are only collected when someone listens to them, so merges don't pay for them
+otherwise:
+
+* receivers of the merge_finished signal, called with sender=DocxTemplate and
+  metrics=MergeMetrics
+* a backend, a dotted path to a function(metrics), set with
+  settings.DJANGO_DOCX_TEMPLATES["metrics_backend"] (log_metrics logs them)
+* templates whose collect_metrics attribute is set, the merge view does it to send a
+  Server-Timing header (settings.DJANGO_DOCX_TEMPLATES["server_timing"])
+
+The metrics of the last merge of a template are kept in its last_merge_metrics
+attribute.
+"""
+import logging
+from pydoc import locate
+from time import perf_counter
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.dispatch import Signal
+
+from .utils import get_setting
+
+
+logger = logging.getLogger(__name__)
+
+merge_finished = Signal()
+
+
+class MergeMetrics:
+    """Duration of the phases of a merge, in seconds, with the size of the merged
+    document and the number of queries run during the merge.
+
+    Phases: validators (ETag or Last-Modified computed by the merge views), context
+    (DataSource), output_cache (lookup of the output cache), load (template cache or
+    storage read and parsing), render (clone and docxtpl render), save (writing the
+    document).
+    """
+
+    def __init__(self, template):
+        self.slug = template.slug
+        self.timings = dict()
+        self.size = None
+        # None when queries can't be counted (async merges)
+        self.queries = 0
+        # True when the document came from the output cache
+        self.cached = False
+        self._last = perf_counter()
+
+    def lap(self, phase) -> None:
+        """Record the time elapsed since the previous lap as the duration of
+        phase."""
+        now = perf_counter()
+        self.timings[phase] = self.timings.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    @property
+    def total(self) -> float:
+        return sum(self.timings.values())
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self._count_query)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def get_server_timing(self) -> str:
+        """Return the value of a Server-Timing header."""
+        timings = self.timings.items()
+        parts = [f"{phase};dur={value * 1000:.1f}" for phase, value in timings]
+        if self.queries is not None:
+            parts.append(f'db;desc="{self.queries} queries"')
+        return ", ".join(parts)
+
+    def as_dict(self) -> dict:
+        return {
+            "slug": self.slug,
+            "timings": dict(self.timings),
+            "total": self.total,
+            "size": self.size,
+            "queries": self.queries,
+            "cached": self.cached,
+        }
+
+
+_metrics_backend = None
+
+
+def get_metrics_backend():
+    """Return the function of settings.DJANGO_DOCX_TEMPLATES["metrics_backend"], or
+    None."""
+    global _metrics_backend
+    if _metrics_backend is None:
+        backend = get_setting("metrics_backend", None)
+        if not backend:
+            return None
+        _metrics_backend = locate(backend)
+        if _metrics_backend is None:
+            raise ImproperlyConfigured(f"Unknown metrics backend {backend}")
+    return _metrics_backend
+
+
+def start_metrics(template):
+    """Return a new MergeMetrics if metrics of template are collected, else None."""
+    if (
+        template.collect_metrics
+        or merge_finished.has_listeners(type(template))
+        or get_metrics_backend() is not None
+    ):
+        return MergeMetrics(template)
+    return None
+
+
+def finish_metrics(template, metrics, document) -> None:
+    """Record the size of document, then publish metrics."""
+    position = document.tell()
+    metrics.size = document.seek(0, 2)
+    document.seek(position)
+    template.last_merge_metrics = metrics
+    backend = get_metrics_backend()
+    if backend is not None:
+        backend(metrics)
+    merge_finished.send(sender=type(template), template=template, metrics=metrics)
+
+
+def log_metrics(metrics) -> None:
+    """Metrics backend writing metrics to the django_docx_template.metrics logger."""
+    logger.info("merge %s", metrics.slug, extra={"docx_metrics": metrics.as_dict()})
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_docx_template", "0002_alter_docxtemplate_slug"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="docxtemplate",
+            name="variables",
+            field=models.JSONField(
+                blank=True, editable=False, null=True, verbose_name="Variables"
+            ),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_docx_template", "0004_mergejob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="docxtemplate",
+            name="content_hash",
+            field=models.CharField(
+                blank=True, editable=False, max_length=64, verbose_name="Content hash"
+            ),
+        ),
+        migrations.AddField(
+            model_name="docxtemplate",
+            name="content_modified_at",
+            field=models.DateTimeField(
+                blank=True,
+                editable=False,
+                null=True,
+                verbose_name="Content modified at",
+            ),
+        ),
+        migrations.AddField(
+            model_name="docxtemplate",
+            name="version",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Version"
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_docx_template", "0005_docxtemplate_content_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mergejob",
+            name="attempts",
+            field=models.PositiveSmallIntegerField(default=0, verbose_name="Attempts"),
+        ),
+    ]
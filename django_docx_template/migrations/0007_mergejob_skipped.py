@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:02
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_docx_template", "0006_mergejob_attempts"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mergejob",
+            name="skipped",
+            field=models.JSONField(
+                blank=True,
+                default=list,
+                encoder=django.core.serializers.json.DjangoJSONEncoder,
+                verbose_name="Skipped url kwargs",
+            ),
+        ),
+    ]
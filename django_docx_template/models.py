@@ -1,15 +1,41 @@
-from io import BytesIO
+import asyncio
+from datetime import timedelta
+from functools import partial
+import hashlib
 from pydoc import locate
-import random
+import shutil
+import tempfile
+import traceback
+import uuid
+import zipfile
 
 from django.conf import settings
-from django.db import models
+from django.core.files import File
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.utils import timezone
 from django.urls import reverse
 from django.utils.text import slugify
+from jinja2 import TemplateError
 
-from docxtpl import DocxTemplate as DocxEngine
-
-from .utils import import_from_string, merge_url_parts
+from .cache import (
+    CachedTemplate,
+    get_local_mirror,
+    get_output_cache,
+    get_template_cache,
+)
+from .engine import DocxEngine
+from .executors import get_merge_executor, get_render_executor
+from .metrics import finish_metrics, start_metrics
+from .routing import reverse_merge
+from .utils import (
+    context_digest,
+    get_setting,
+    import_from_string,
+    iter_zip,
+    merge_url_parts,
+    new_document_file,
+)
 from .data_sources import DataSource
 
 
@@ -30,34 +56,191 @@ class DocxTemplate(models.Model):
     data_source_class = models.CharField(
         "DataSource class", max_length=250, blank=True, null=True
     )
+    # root variables used by the docx, extracted when the file is uploaded. None
+    # when unknown, then every field of the DataSource is fetched.
+    variables = models.JSONField("Variables", blank=True, null=True, editable=False)
+    # sha256 of the docx file and counter incremented when it changes, see
+    # update_content_hash
+    content_hash = models.CharField(
+        "Content hash", max_length=64, blank=True, editable=False
+    )
+    version = models.PositiveIntegerField("Version", default=0, editable=False)
+    content_modified_at = models.DateTimeField(
+        "Content modified at", blank=True, null=True, editable=False
+    )
+
+    # collect the metrics of merges even without receiver nor backend, see metrics.py
+    collect_metrics = False
+    last_merge_metrics = None
 
     @property
     def data_source(self) -> DataSource:
-        return import_from_string(self.data_source_class)
+        """DataSource of the template, instantiated once unless data_source_class
+        changes."""
+        data_source = self.__dict__.get("_data_source")
+        if data_source is None or data_source.class_path != self.data_source_class:
+            data_source = import_from_string(self.data_source_class)
+            self._data_source = data_source
+        data_source.used_variables = self.variables
+        return data_source
 
     def get_absolute_url(self):
         return reverse("docx_template:detail", args={"slug": self.slug})
 
     def get_merge_url(self) -> str:
-        """This method is used for building urls.py, therefore it can't use reverse()"""
+        """Return the pattern of the merge url, relative to the app urls (used for
+        documentation, see get_merge_absolute_url to build an actual url)"""
         return merge_url_parts(
             f"templates/merge/{self.slug}",
             self.data_source.get_url(),
         )
 
+    def get_merge_absolute_url(self, **kwargs) -> str:
+        """Return the url merging this template with the given DataSource kwargs."""
+        return reverse_merge(self, **kwargs)
+
     def save(self, *args, **kwargs) -> None:
         if not self.slug:
             self.slug = slugify(self.name)
+        if not self.docx._committed or self.variables is None:
+            self.variables = self.get_template_variables()
+        if not self.docx._committed or not self.content_hash:
+            self.update_content_hash()
         super().save(*args, **kwargs)
+        get_template_cache().invalidate(self.slug)
+
+    def delete(self, *args, **kwargs):
+        get_template_cache().invalidate(self.slug)
+        return super().delete(*args, **kwargs)
+
+    def get_template_variables(self):
+        """Return the sorted list of root variables used by the docx file, or None if
+        the file can't be parsed."""
+        try:
+            docx_engine = self._load_engine(self._load_template())
+            return sorted(docx_engine.get_template_variables())
+        except (zipfile.BadZipFile, KeyError, ValueError, OSError, TemplateError):
+            return None
+
+    def get_content_hash(self) -> str:
+        """Return the sha256 of the content of the docx file."""
+        hasher = hashlib.sha256()
+        if self.docx._committed:
+            with self.docx.open("rb") as docx_file:
+                for chunk in docx_file.chunks():
+                    hasher.update(chunk)
+        else:
+            for chunk in self.docx.chunks():
+                hasher.update(chunk)
+            self.docx.seek(0)
+        return hasher.hexdigest()
+
+    def update_content_hash(self) -> None:
+        """Hash the docx file and increment version when its content changed. An
+        upload identical to a file already stored (by this template or another one)
+        is not stored again: the stored file is reused.
+
+        Nothing is done without a file. When the stored file is missing, content_hash
+        is left as it is, get_file_version() then falls back to the file name."""
+        if not self.docx:
+            return
+        try:
+            content_hash = self.get_content_hash()
+        except OSError:
+            return
+        if content_hash != self.content_hash:
+            self.content_hash = content_hash
+            self.version += 1
+            self.content_modified_at = timezone.now()
+        if not self.docx._committed:
+            stored_name = self.get_stored_duplicate(content_hash)
+            if stored_name is not None:
+                self.docx = stored_name
+
+    def get_stored_duplicate(self, content_hash):
+        """Return the name of a stored docx file whose content hash is content_hash,
+        or None."""
+        names = (
+            DocxTemplate.objects.filter(content_hash=content_hash)
+            .exclude(docx="")
+            .values_list("docx", flat=True)
+            .distinct()
+        )
+        for name in names:
+            if self.docx.storage.exists(name):
+                return name
+        return None
+
+    def get_file_version(self) -> str:
+        """Return a string that changes whenever the docx file changes. It keys the
+        caches of parsed templates and merged documents, and ETags: the content hash
+        is the same in every process and node. Files saved before content hashes
+        existed fall back to their name, size and modification time."""
+        if self.content_hash:
+            return self.content_hash
+        modified = self.get_file_modified_time()
+        return f"{self.docx.name}:{self.docx.size}:{modified}"
+
+    def get_file_modified_time(self):
+        """Return the timestamp of the last change of the docx content, or None if it
+        is unknown."""
+        if self.content_modified_at is not None:
+            return self.content_modified_at.timestamp()
+        try:
+            return self.docx.storage.get_modified_time(self.docx.name).timestamp()
+        except (NotImplementedError, OSError):
+            return None
+
+    def _load_template(self, normalize=False) -> CachedTemplate:
+        """Read and parse the docx file (see CachedTemplate.from_bytes). Stored files
+        are read through the local mirror when it is enabled (see
+        cache.get_local_mirror)."""
+        mirror = get_local_mirror()
+        if self.docx._committed and mirror is not None and self.content_hash:
+            content = mirror.read(self.docx, self.content_hash)
+        elif self.docx._committed:
+            with self.docx.open("rb") as docx_file:
+                content = docx_file.read()
+        else:
+            # uploaded file not saved in the storage yet, it must stay open
+            self.docx.seek(0)
+            content = self.docx.read()
+            self.docx.seek(0)
+        return CachedTemplate.from_bytes(content, normalize=normalize)
+
+    def _get_cached_template(self) -> CachedTemplate:
+        """Return the parsed template. Saved templates are parsed once per process and
+        kept in the template cache."""
+        if self.slug and self.docx._committed:
+            key = (self.slug, self.get_file_version())
+            loader = partial(self._load_template, normalize=True)
+            return get_template_cache().get_or_load(key, loader)
+        return self._load_template()
 
-    def _clean_context(self, docx_engine, context):
-        """Hook to transform context data before merging document."""
+    def _load_engine(self, cached: CachedTemplate = None) -> DocxEngine:
+        """Return a DocxEngine ready to be rendered, working on a clone of the cached
+        template and reusing its compiled Jinja templates."""
+        if cached is None:
+            cached = self._get_cached_template()
+        docx_engine = DocxEngine(
+            self.docx, compiled=cached.compiled, source=cached.source
+        )
+        docx_engine.docx = cached.clone()
+        return docx_engine
+
+    def _clean_context(self, docx_engine, context) -> dict:
+        """Hook to transform context data before merging document. Return the context
+        to render, the given one is left untouched."""
+        context = dict(self.data_source.convert_context(context, docx_engine))
         self._clean_context_image(docx_engine, context)
+        return context
 
     def _clean_context_image(self, docx_engine, context):
         """
         Because we need a reference to DocxTemplate to correctly add image
-        we have to wait the very last moment to init InLine object.
+        we have to wait the very last moment to init InLine object. Images can be
+        anywhere in the context (see DataSource.convert_context), images stored in
+        context["images"] are also available at the root of the context.
 
         Example of 'context' parameter:
         ===============================
@@ -73,35 +256,47 @@ class DocxTemplate(models.Model):
             "image_1": InlineImage(...),
             "image_2": InlineImage(...),
         }
-
-        Todo
-        ====
-        . avoid storing all images in a specific part of the context, make a recursive
-        function to find all instances of previous class to replace it with correct
-        InLine image
         """
         context["cleaned_images"] = list()
-        images = context.get("images", list())
+        images = context.get("images", dict())
         for name, image in images.items():
-            context[name] = image.convert(docx_engine)
+            context[name] = image
 
-    def _merge(self, context: dict()) -> BytesIO:
-        """Load actual docx file and merge all fields. Return the final doc as BytesIO."""
-        docx_engine = DocxEngine(self.docx)
-        self._clean_context(docx_engine, context)
+    def _merge(
+        self, context: dict(), cached: CachedTemplate = None, metrics=None
+    ):
+        """Load actual docx file and merge all fields. Return the final doc as a file
+        object (see utils.new_document_file), positioned at its start. Phases are timed
+        when metrics (see metrics.MergeMetrics) is given."""
+        if cached is None:
+            cached = self._get_cached_template()
+        if metrics is not None:
+            metrics.lap("load")
+        docx_engine = self._load_engine(cached)
+        context = self._clean_context(docx_engine, context)
         docx_engine.render(context)
-        buffer = BytesIO()
+        if metrics is not None:
+            metrics.lap("render")
+        buffer = new_document_file()
         docx_engine.save(buffer)
         buffer.seek(0)
+        if metrics is not None:
+            metrics.lap("save")
         return buffer
 
-    def merge(self, **kwargs) -> BytesIO:
-        """Load the docx template and merge it. Then return it as in memory object
+    def merge(self, **kwargs):
+        """Load the docx template and merge it. Then return it as a file object
 
         1. Load dynamically the data_source and get context data from it
         2. Open the filefield as DocxTemplate
         3. merge document
-        4. save the new document in memory and return it
+        4. save the new document in a spooled file and return it
+
+        When the output cache is enabled (see cache.get_output_cache), a document
+        already merged with the same context is returned without rendering.
+
+        When metrics are collected (see metrics.py), the timings of the merge are
+        published and kept in last_merge_metrics.
 
         Parameters
         ==========
@@ -109,15 +304,311 @@ class DocxTemplate(models.Model):
 
         Return
         ======
-        BytesIO
+        File object, in memory for small documents and on disk for big ones (see
+        utils.new_document_file), or read from the output cache
         """
-        context = self.data_source.get_context_data(**kwargs)
-        return self._merge(context=context)
+        return self.merge_timed(kwargs=kwargs)
+
+    def merge_context(self, context):
+        """Same as merge(), with context data already fetched (for example by a view
+        computing the ETag of the document, see get_etag)."""
+        return self.merge_timed(context=context)
+
+    def merge_timed(self, kwargs=None, context=None, metrics=None):
+        """Merge context, or the context of kwargs when it is None, collecting
+        metrics if needed.
+
+        metrics is a MergeMetrics already started by the caller (see
+        start_metrics), the merge phases are added to it. The merge views use it to
+        include the computation of the ETag.
+        """
+        if metrics is None:
+            metrics = start_metrics(self)
+        if context is not None:
+            kwargs = None
+        if metrics is None:
+            if kwargs is not None:
+                context = self.data_source.get_context_data(**kwargs)
+            return self._merge_context(context)
+        with metrics:
+            if kwargs is not None:
+                context = self.data_source.get_context_data(**kwargs)
+                metrics.lap("context")
+            document = self._merge_context(context, metrics)
+        finish_metrics(self, metrics, document)
+        return document
+
+    def _merge_context(self, context, metrics=None):
+        """Merge context, going through the output cache when it is enabled."""
+        output_cache = get_output_cache()
+        key = None
+        if output_cache is not None:
+            key = self.get_output_cache_key(context)
+        if key is not None:
+            document = output_cache.get(key)
+            if metrics is not None:
+                metrics.lap("output_cache")
+            if document is not None:
+                if metrics is not None:
+                    metrics.cached = True
+                return document
+        buffer = self._merge(context=context, metrics=metrics)
+        if key is not None:
+            output_cache.set(key, buffer)
+            if metrics is not None:
+                metrics.lap("output_cache")
+        return buffer
+
+    def get_output_cache_key(self, context):
+        """Return the output cache key of the document merged with context: a hash of
+        the template version and of the context. None if it can't be cached."""
+        if not (self.slug and self.docx._committed):
+            return None
+        digest = context_digest(context)
+        if digest is None:
+            return None
+        key = f"{self.slug}:{self.get_file_version()}:{digest}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get_etag(self, context):
+        """Return the ETag of the document merged with context, built without
+        rendering it, or None. It changes with the template file and the context."""
+        key = self.get_output_cache_key(context)
+        return None if key is None else f'"{key}"'
+
+    def get_last_modified(self, **kwargs):
+        """Return the timestamp of the last modification of the document merged with
+        kwargs: the most recent of the template file and of the DataSource data (see
+        DataSource.get_last_modified). None if one of them is unknown."""
+        data_modified = self.data_source.get_last_modified(**kwargs)
+        if data_modified is None or not self.docx._committed:
+            return None
+        file_modified = self.get_file_modified_time()
+        if file_modified is None:
+            return None
+        return max(data_modified.timestamp(), file_modified)
+
+    async def amerge(self, **kwargs):
+        """Async version of merge(). Context data are loaded with
+        DataSource.aget_context_data() and the document is rendered in the render
+        executor (see executors.get_render_executor), the event loop is never
+        blocked."""
+        return await self.amerge_timed(kwargs=kwargs)
+
+    async def amerge_context(self, context):
+        """Async version of merge_context()."""
+        return await self.amerge_timed(context=context)
 
-    def merge_example(self, example_number=None) -> BytesIO:
-        if example_number:
+    async def amerge_timed(self, kwargs=None, context=None, metrics=None):
+        """Async version of merge_timed()."""
+        if metrics is None:
+            metrics = start_metrics(self)
+        if context is None and kwargs is not None:
+            context = await self.data_source.aget_context_data(**kwargs)
+            if metrics is not None:
+                metrics.lap("context")
+        loop = asyncio.get_running_loop()
+        document = await loop.run_in_executor(
+            get_render_executor(),
+            partial(self._merge_context, context, metrics=metrics),
+        )
+        if metrics is not None:
+            # queries of the async ORM are not counted
+            metrics.queries = None
+            finish_metrics(self, metrics, document)
+        return document
+
+    def merge_many(self, url_kwargs_list, chunk_size=None, executor=None):
+        """Merge one document for each item of url_kwargs_list.
+
+        Context data are fetched by chunk (see DataSource.get_context_data_many) and
+        the template is loaded once for the whole batch. Documents are merged lazily,
+        so memory stays flat whatever the size of the batch.
+
+        Parameters
+        ==========
+        * url_kwargs_list: iterable of dict, each one being the kwargs of merge()
+        * chunk_size: number of contexts fetched per query
+        * executor: executor rendering documents, default to the one configured in
+          settings (see executors.py)
+
+        Return
+        ======
+        Generator of (url_kwargs, file object), the file is None when no context data
+        was found for url_kwargs.
+        """
+        if executor is None:
+            executor = get_merge_executor()
+        contexts = self.data_source.get_context_data_many(
+            url_kwargs_list, chunk_size=chunk_size
+        )
+        return executor.render(self, contexts)
+
+    def get_document_name(self, url_kwargs=None) -> str:
+        """Return the file name of a document merged with url_kwargs."""
+        parts = [self.name.replace(" ", "_")]
+        parts += [str(value) for value in (url_kwargs or {}).values()]
+        return "_".join(parts) + ".docx"
+
+    def enqueue_merge(self, **kwargs) -> "MergeJob":
+        """Return a MergeJob merging this template in the background, with the same
+        kwargs as merge(). Jobs are run by the docx_worker command."""
+        return MergeJob.objects.create(template=self, url_kwargs=[kwargs])
+
+    def enqueue_merge_many(self, url_kwargs_list) -> "MergeJob":
+        """Return a MergeJob building the zip of the documents merged for each item of
+        url_kwargs_list (see merge_many), in the background."""
+        return MergeJob.objects.create(
+            template=self, url_kwargs=list(url_kwargs_list), bulk=True
+        )
+
+    def merge_example(self, example_number=None):
+        if example_number is not None:
             context = self.data_source.get_example(example_number)
         else:
-            combinations = self.data_source.get_all_example_combinations()
-            context = random.choice(combinations)
+            context = self.data_source.get_all_example_combinations().random()
         return self._merge(context=context)
+
+
+class MergeJob(models.Model):
+    """A merge run in the background by a worker (see the docx_worker command). The
+    merged document, or the zip of a bulk merge, is stored in the default storage.
+
+    A job running for longer than settings.DJANGO_DOCX_TEMPLATES["job_timeout"]
+    (seconds, default 3600) is considered lost with its worker and claimed again, at
+    most "job_max_attempts" times (default 3) before it fails. Finished jobs and their
+    result are deleted after "job_retention" seconds (default 7 days, see
+    delete_expired).
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    # not guessable, it is used in the status and download urls
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    template = models.ForeignKey(
+        DocxTemplate, on_delete=models.CASCADE, related_name="merge_jobs"
+    )
+    # list of merge kwargs, a single item unless bulk is set
+    url_kwargs = models.JSONField("Url kwargs", default=list, encoder=DjangoJSONEncoder)
+    bulk = models.BooleanField("Bulk merge", default=False)
+    status = models.CharField(
+        "Status", max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True
+    )
+    result = models.FileField("Result", upload_to="docx_template/jobs/", blank=True)
+    error = models.TextField("Error", blank=True)
+    created_at = models.DateTimeField("Created at", auto_now_add=True)
+    started_at = models.DateTimeField("Started at", blank=True, null=True)
+    finished_at = models.DateTimeField("Finished at", blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField("Attempts", default=0)
+    # url kwargs of a bulk merge without data, left out of the zip
+    skipped = models.JSONField(
+        "Skipped url kwargs", default=list, blank=True, encoder=DjangoJSONEncoder
+    )
+
+    class Meta:
+        ordering = ["created_at"]
+
+    @classmethod
+    def claim(cls):
+        """Return the oldest pending or lost job, marked as running, or None. Rows
+        locked by other workers are skipped, so several workers can share the queue.
+        Lost jobs which ran out of attempts are failed."""
+        now = timezone.now()
+        max_attempts = get_setting("job_max_attempts", 3)
+        lost = models.Q(
+            status=cls.RUNNING,
+            started_at__lt=now - timedelta(seconds=get_setting("job_timeout", 3600)),
+        )
+        jobs = cls.objects.select_for_update(skip_locked=True)
+        jobs = jobs.filter(models.Q(status=cls.PENDING) | lost).order_by("created_at")
+        with transaction.atomic():
+            job = jobs.first()
+            while job is not None and job.attempts >= max_attempts:
+                job.status = cls.FAILED
+                job.error = f"Worker lost after {job.attempts} attempts"
+                job.finished_at = now
+                job.save(update_fields=["status", "error", "finished_at"])
+                job = jobs.first()
+            if job is not None:
+                job.status = cls.RUNNING
+                job.started_at = now
+                job.attempts += 1
+                job.save(update_fields=["status", "started_at", "attempts"])
+        return job
+
+    @classmethod
+    def delete_expired(cls) -> int:
+        """Delete the jobs finished for longer than
+        settings.DJANGO_DOCX_TEMPLATES["job_retention"] seconds, and their result.
+        Return the number of deleted jobs."""
+        retention = timedelta(seconds=get_setting("job_retention", 7 * 24 * 3600))
+        expired = cls.objects.filter(
+            status__in=[cls.DONE, cls.FAILED],
+            finished_at__lt=timezone.now() - retention,
+        )
+        deleted = 0
+        for job in expired.iterator():
+            if job.result:
+                job.result.delete(save=False)
+            job.delete()
+            deleted += 1
+        return deleted
+
+    def get_file_name(self) -> str:
+        if self.bulk:
+            return self.template.name.replace(" ", "_") + ".zip"
+        return self.template.get_document_name(self.url_kwargs[0])
+
+    def run(self) -> None:
+        """Merge the document(s) and store the result. Errors are recorded on the
+        job, which is then failed. Items of a bulk merge without data are recorded in
+        skipped, the job fails when all of them are skipped."""
+        try:
+            with tempfile.TemporaryFile() as result:
+                self.write_result(result)
+                result.seek(0)
+                self.result.save(self.get_file_name(), File(result), save=False)
+        except Exception:
+            self.status = self.FAILED
+            self.error = traceback.format_exc()
+        else:
+            self.status = self.DONE
+        self.finished_at = timezone.now()
+        self.save(
+            update_fields=["status", "result", "error", "skipped", "finished_at"]
+        )
+
+    def write_result(self, result) -> None:
+        # values of url kwargs come back from JSON as strings (UUID, date...)
+        data_source = self.template.data_source
+        url_kwargs_list = [
+            data_source.to_python_url_kwargs(url_kwargs) for url_kwargs in self.url_kwargs
+        ]
+        if not self.bulk:
+            with self.template.merge(**url_kwargs_list[0]) as document:
+                shutil.copyfileobj(document, result)
+            return
+        self.skipped = []
+        for data in iter_zip(self.iter_entries(url_kwargs_list)):
+            result.write(data)
+        if len(self.skipped) == len(url_kwargs_list):
+            raise ValueError("No data found for any of the url kwargs.")
+
+    def iter_entries(self, url_kwargs_list):
+        """Yield the (name, document) zip entries of a bulk merge, recording the url
+        kwargs without data in skipped."""
+        merged = self.template.merge_many(url_kwargs_list)
+        for stored, (url_kwargs, buffer) in zip(self.url_kwargs, merged):
+            if buffer is None:
+                self.skipped.append(stored)
+            else:
+                yield self.template.get_document_name(url_kwargs), buffer
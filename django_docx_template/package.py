@@ -0,0 +1,155 @@
+"""Writing of docx packages reusing the compressed members of the template.
+
+Rendering only changes a few parts of a document (body, headers, footers, relations,
+new images). Instead of deflating every member again, members whose content is the
+same as in the template are copied from it as raw compressed bytes.
+
+The reference is the template as python-docx serializes it (see normalize_package),
+computed once per template version: parsed then serialized parts don't keep the
+formatting of the original file, so they can only be compared with a serialization.
+
+Raw copies rely on internals of zipfile, and writing a package with another physical
+writer on private methods of python-docx PackageWriter. They are checked once
+(RAW_COPY, PACKAGE_WRITER): without them members are compressed again, or the
+package is saved by python-docx.
+"""
+
+import copy
+import hashlib
+from io import BytesIO
+from pathlib import PurePosixPath
+import struct
+import zipfile
+
+from docx.opc.pkgwriter import PackageWriter
+
+# media already compressed, deflating them again is slow and saves nothing
+STORED_EXTENSIONS = {".gif", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".wdp"}
+
+
+def has_raw_copy_internals() -> bool:
+    """Whether zipfile has the internals PassThroughZipWriter.copy_raw uses."""
+    names = (
+        "_FH_FILENAME_LENGTH",
+        "_FH_EXTRA_FIELD_LENGTH",
+        "structFileHeader",
+        "sizeFileHeader",
+    )
+    if not all(hasattr(zipfile, name) for name in names):
+        return False
+    with zipfile.ZipFile(BytesIO(), "w") as zipf:
+        names = ("_lock", "start_dir", "_didModify", "fp", "filelist", "NameToInfo")
+        return all(hasattr(zipf, name) for name in names)
+
+
+RAW_COPY = has_raw_copy_internals()
+PACKAGE_WRITER = all(
+    hasattr(PackageWriter, name)
+    for name in ("_write_content_types_stream", "_write_pkg_rels", "_write_parts")
+)
+
+
+def get_digest(blob: bytes) -> tuple:
+    return len(blob), hashlib.sha1(blob).digest()
+
+
+class SourcePackage:
+    """Serialized template: zip content and digest of each member."""
+
+    def __init__(self, content: bytes, digests: dict):
+        self.content = content
+        self.digests = digests
+
+
+class PassThroughZipWriter:
+    """Physical package writer of python-docx. Members found unchanged in source (a
+    SourcePackage) are copied as raw compressed bytes, compressed images are stored
+    and others are deflated with compresslevel."""
+
+    def __init__(self, pkg_file, source=None, compresslevel=None):
+        self._zipf = zipfile.ZipFile(
+            pkg_file, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel
+        )
+        self._source = None
+        self._digests = dict()
+        if source is not None:
+            self._source = zipfile.ZipFile(BytesIO(source.content))
+            self._digests = source.digests
+
+    def write(self, pack_uri, blob) -> None:
+        name = pack_uri.membername
+        digest = self._digests.get(name)
+        # the length is compared first, hashing is only done for candidates
+        if (
+            RAW_COPY
+            and digest is not None
+            and digest[0] == len(blob)
+            and digest == get_digest(blob)
+        ):
+            self.copy_raw(self._source.getinfo(name))
+        elif PurePosixPath(name).suffix.lower() in STORED_EXTENSIONS:
+            self._zipf.writestr(name, blob, compress_type=zipfile.ZIP_STORED)
+        else:
+            self._zipf.writestr(name, blob)
+
+    def copy_raw(self, info) -> None:
+        """Copy the member info of the source package without decompressing it."""
+        source_fp = self._source.fp
+        source_fp.seek(info.header_offset)
+        header = struct.unpack(
+            zipfile.structFileHeader, source_fp.read(zipfile.sizeFileHeader)
+        )
+        source_fp.seek(
+            header[zipfile._FH_FILENAME_LENGTH]
+            + header[zipfile._FH_EXTRA_FIELD_LENGTH],
+            1,
+        )
+        raw = source_fp.read(info.compress_size)
+
+        zipf = self._zipf
+        new_info = copy.copy(info)
+        # sizes and CRC are known, they go in the header, not in a data descriptor
+        new_info.flag_bits &= ~0x08
+        new_info.extra = b""
+        with zipf._lock:
+            zipf.fp.seek(zipf.start_dir)
+            new_info.header_offset = zipf.fp.tell()
+            zipf.fp.write(new_info.FileHeader())
+            zipf.fp.write(raw)
+            zipf.start_dir = zipf.fp.tell()
+            zipf.filelist.append(new_info)
+            zipf.NameToInfo[new_info.filename] = new_info
+            zipf._didModify = True
+
+    def close(self) -> None:
+        self._zipf.close()
+        if self._source is not None:
+            self._source.close()
+
+
+def write_package(pkg_file, package, source=None, compresslevel=None) -> None:
+    """Save package (docx.opc.package.OpcPackage) to pkg_file, as
+    OpcPackage.save does, reusing the unchanged members of source."""
+    if not PACKAGE_WRITER:
+        package.save(pkg_file)
+        return
+    parts = list(package.iter_parts())
+    for part in parts:
+        part.before_marshal()
+    writer = PassThroughZipWriter(pkg_file, source, compresslevel)
+    PackageWriter._write_content_types_stream(writer, parts)
+    PackageWriter._write_pkg_rels(writer, package.rels)
+    PackageWriter._write_parts(writer, parts)
+    writer.close()
+
+
+def normalize_package(document, compresslevel=None) -> SourcePackage:
+    """Return the SourcePackage of a parsed template (docx.Document)."""
+    buffer = BytesIO()
+    write_package(buffer, document.part.package, compresslevel=compresslevel)
+    content = buffer.getvalue()
+    with zipfile.ZipFile(buffer) as package:
+        digests = {
+            info.filename: get_digest(package.read(info)) for info in package.infolist()
+        }
+    return SourcePackage(content, digests)
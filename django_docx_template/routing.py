@@ -0,0 +1,93 @@
+"""Routing of merge urls.
+
+All merge urls go through a single catch-all url (templates/merge/<slug>/<url_args>).
+The url arguments of each template are matched against the url of its DataSource,
+found in a routing table kept in memory. The table is filled lazily, one template at
+a time, and entries are dropped when a template is saved or deleted (see signals.py),
+so the url of a new template works immediately and starting a process doesn't query
+the database.
+"""
+from threading import RLock
+
+from django.urls import reverse
+from django.urls.resolvers import RoutePattern
+
+from .utils import import_from_string
+
+
+class MergeRouter:
+    def __init__(self):
+        self._routes = dict()
+        self._lock = RLock()
+
+    def get_route(self, slug, template=None):
+        """Return (data_source_class, RoutePattern) of a template, or None if the
+        template doesn't exist. A route missing from the table is built from
+        template, the DocxTemplate of slug, when the caller already loaded it, else
+        from the database."""
+        route = self._routes.get(slug)
+        if route is None:
+            if template is not None:
+                route = self.build_route(template.data_source_class)
+            else:
+                route = self.load_route(slug)
+            if route is not None:
+                with self._lock:
+                    self._routes[slug] = route
+        return route
+
+    def load_route(self, slug):
+        from .models import DocxTemplate
+
+        templates = DocxTemplate.objects.filter(slug=slug)
+        data_source_class = templates.values_list("data_source_class", flat=True)
+        data_source_class = data_source_class.first()
+        if data_source_class is None:
+            return None
+        return self.build_route(data_source_class)
+
+    def build_route(self, data_source_class):
+        data_source = import_from_string(data_source_class)
+        pattern = RoutePattern(data_source.get_url(), is_endpoint=True)
+        return data_source_class, pattern
+
+    def resolve(self, slug, url_args="", template=None):
+        """Return the DataSource kwargs of url_args, converted to python values, or
+        None if the template doesn't exist or url_args don't match its DataSource.
+        template is passed to get_route()."""
+        route = self.get_route(slug, template)
+        if route is None:
+            return None
+        match = route[1].match(url_args)
+        if match is None:
+            return None
+        return match[2]
+
+    def get_data_source_class(self, slug, template=None):
+        route = self.get_route(slug, template)
+        return route[0] if route else None
+
+    def invalidate(self, slug=None) -> None:
+        """Drop the route of a template, or the whole table if slug is None."""
+        with self._lock:
+            if slug is None:
+                self._routes.clear()
+            else:
+                self._routes.pop(slug, None)
+
+
+router = MergeRouter()
+
+
+def reverse_merge(template, **kwargs) -> str:
+    """Return the url merging template with the given DataSource kwargs."""
+    data_source = template.data_source
+    converters = RoutePattern(data_source.get_url()).converters
+    url_args = "/".join(
+        converters[name].to_url(kwargs[name]) for name in data_source.url_args or {}
+    )
+    if not url_args:
+        return reverse("docx_template:merge", kwargs={"slug": template.slug})
+    return reverse(
+        "docx_template:merge", kwargs={"slug": template.slug, "url_args": url_args}
+    )
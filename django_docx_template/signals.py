@@ -0,0 +1,13 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import DocxTemplate
+from .routing import router
+
+
+@receiver(post_save, sender=DocxTemplate)
+@receiver(post_delete, sender=DocxTemplate)
+def invalidate_merge_route(sender, instance, **kwargs):
+    """Drop the merge route of a saved or deleted template, it is loaded again on the
+    next merge."""
+    router.invalidate(instance.slug)
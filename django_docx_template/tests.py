@@ -1,18 +1,42 @@
 """
 
 """
-from io import BytesIO
+from asgiref.sync import async_to_sync
+import datetime
+import hashlib
+from io import BytesIO, StringIO
+import os
 import pytest
+import zipfile
 from pathlib import Path
 
 from django.conf import settings
+from django.contrib.auth.models import Group, User
 
-# from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import Http404, QueryDict
+from django.urls import resolve, reverse
 
+from . import benchmark
 from . import data_sources
-from .models import DocxTemplate
+from . import engine
+from .apps import check_data_sources
+from . import executors
+from . import metrics
+from . import package
+from . import cache
+from .cache import CachedTemplate, TemplateCache, get_template_cache
+from .cache import DjangoCacheBackend, FileSystemBackend
+from .models import DocxTemplate, MergeJob
+from . import routing
 from . import utils
+from . import warmup
+from . import views
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -44,6 +68,51 @@ class ImageDataSource(data_sources.DataSource):
         }
 
 
+class TemplateDataSource(data_sources.DataSource):
+    label = "Docx templates"
+    model = DocxTemplate
+    url_args = {"slug": "slug"}
+    bulk_filter_args = {"data_source_class": "str"}
+    name = data_sources.CharField(examples=["Contract", "Invoice"])
+    file_name = data_sources.CharField(source="docx")
+
+
+class JobDataSource(data_sources.DataSource):
+    model = MergeJob
+    url_args = {"id": "uuid"}
+    status = data_sources.CharField(examples=["done"])
+
+
+class PrunedTemplateDataSource(TemplateDataSource):
+    label = "Docx templates, fetching only the fields used"
+    prune_fields = True
+
+
+class UserDataSource(data_sources.DataSource):
+    label = "Users and their groups"
+    model = User
+    url_args = {"pk": "int"}
+    username = data_sources.CharField(examples=["ann"])
+    groups = data_sources.RelatedListField(
+        fields={"group": "name"}, examples=[[{"group": "Staff"}]]
+    )
+
+
+class ModifiedDataSource(TemplateDataSource):
+    label = "Docx templates with a modification date"
+
+    def get_last_modified(self, **keys):
+        return datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class ManyExamplesDataSource(data_sources.DataSource):
+    label = "Ten fields of five examples"
+    url_args = {"pk": "int"}
+    locals().update(
+        {f"field_{i}": data_sources.Field(examples=list(range(5))) for i in range(10)}
+    )
+
+
 class TestSimpleDataSource:
     def test_class_path(self):
         sds = SimpleDataSource("any/class/path")
@@ -60,6 +129,26 @@ class TestSimpleDataSource:
         assert "birth_year" in data
         assert data["birth_year"].data_type is int
 
+    def test_data_fields_computed_once_per_class(self):
+        data = SimpleDataSource("any/class/path").get_data_fields()
+        assert data is SimpleDataSource("other/class/path").get_data_fields()
+        with pytest.raises(TypeError):
+            data["new_field"] = data_sources.Field()
+
+        class ChildDataSource(SimpleDataSource):
+            color = data_sources.Field(source="color__label")
+
+        child = ChildDataSource("any/class/path")
+        assert list(child.get_data_fields()) == [
+            "birth_year",
+            "color",
+            "first_name",
+            "last_name",
+        ]
+        fields, expressions = child.get_queryset_fields()
+        assert fields == ("birth_year", "first_name", "last_name")
+        assert list(expressions) == ["color"]
+
     def test_get_data_definition(self):
         sds = SimpleDataSource("any/class/path")
         data = sds.get_data_definition()
@@ -90,6 +179,122 @@ class TestSimpleDataSource:
         sds
 
 
+class Converter(data_sources.ConverterMixin):
+    def __init__(self, name):
+        self.name = name
+
+    def convert(self, docx_engine):
+        return f"converted {self.name}"
+
+
+class ConverterDataSource(data_sources.DataSource):
+    pass
+
+
+class TestConverters:
+    def make_context(self, rows=2, signature=None):
+        return {
+            "title": "Attendance",
+            "signature": signature,
+            "rows": [
+                {"name": f"row {i}", "photo": Converter(f"photo {i}")}
+                for i in range(rows)
+            ],
+            "logos": (Converter("logo"), "text"),
+        }
+
+    def test_walk_converters(self):
+        context = self.make_context()
+        rows = context["rows"]
+        converted = data_sources.walk_converters(context, None)
+        assert converted is not context
+        assert converted["rows"][1]["photo"] == "converted photo 1"
+        assert converted["logos"] == ("converted logo", "text")
+        assert converted["title"] == "Attendance"
+        # the given context is left untouched
+        assert context["rows"] is rows
+        assert isinstance(rows[1]["photo"], Converter)
+        assert isinstance(context["logos"][0], Converter)
+        assert data_sources.walk_converters(converted, None) is converted
+
+    def test_convert_context_any_shape(self):
+        ds = ConverterDataSource("")
+        first = {**self.make_context(), "new_key": ""}
+        first["rows"][0]["photo"] = ""
+        ds.convert_context(first, None)
+        context = self.make_context(rows=3, signature=Converter("signature"))
+        context["new_key"] = [Converter("new")]
+        converted = ds.convert_context(context, None)
+        assert converted["rows"][0]["photo"] == "converted photo 0"
+        assert converted["rows"][2]["photo"] == "converted photo 2"
+        assert converted["signature"] == "converted signature"
+        assert converted["new_key"] == ["converted new"]
+
+    def test_shared_context(self):
+        path = "django_docx_template/static/django_docx_template/test_image.png"
+        images = {"image_1": data_sources.Image(path, width=20)}
+        template = DocxTemplate(
+            name="Shared images",
+            docx=SimpleUploadedFile("template.docx", make_docx("{{ image_1 }}")),
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        cached = template._load_template()
+        for _ in range(2):
+            document = template._merge({"images": images}, cached=cached)
+            names = zipfile.ZipFile(document).namelist()
+            assert any(name.startswith("word/media/image1") for name in names)
+        assert isinstance(images["image_1"], data_sources.Image)
+
+
+class TestExampleCombinations:
+    def test_same_order_as_product(self):
+        sds = SimpleDataSource("any/class/path")
+        combinations = sds.get_all_example_combinations()
+        assert len(combinations) == 3
+        assert list(combinations) == [combinations[i] for i in range(3)]
+        assert combinations[1] == {
+            "birth_year": "1992",
+            "first_name": None,
+            "last_name": None,
+        }
+        assert combinations[-1]["birth_year"] == "2002"
+        with pytest.raises(IndexError):
+            combinations[3]
+
+    def test_lazy_random_access(self):
+        combinations = ManyExamplesDataSource("").get_all_example_combinations()
+        assert len(combinations) == 5**10
+        assert combinations[0] == {f"field_{i}": "0" for i in range(10)}
+        assert combinations[len(combinations) - 1]["field_0"] == "4"
+        assert combinations[7]["field_9"] == "2"
+        assert combinations[7]["field_8"] == "1"
+        assert combinations[5:7] == [combinations[5], combinations[6]]
+        assert len(combinations.sample(3)) == 3
+        assert combinations.random()["field_3"] in ["0", "1", "2", "3", "4"]
+
+    def test_count_above_maxsize(self):
+        fields = {f"field_{i}": data_sources.Field(examples=[1, 2]) for i in range(100)}
+        combinations = data_sources.ExampleCombinations(fields)
+        assert combinations and combinations.count() == 2**100
+        assert combinations[2**100 - 1]["field_0"] == "2"
+
+    @pytest.mark.django_db
+    def test_detail_view_paginates(self, rf):
+        content = open("django_docx_template/test_doc.docx", "rb").read()
+        template = DocxTemplate(
+            name="Many examples",
+            docx=SimpleUploadedFile("template.docx", content),
+            data_source_class="django_docx_template.tests.ManyExamplesDataSource",
+        )
+        template.save()
+        view = views.TemplateDetailView.as_view()
+        response = view(rf.get("/", {"page": 3}), slug=template.slug)
+        examples = response.context_data["examples"]
+        assert len(examples) == views.ExamplesMixin.examples_paginate_by
+        assert examples[0][0] == 40
+        assert response.context_data["examples_page"].paginator.count == 5**10
+
+
 class TestImage:
     def test_instance_isnstance_of_convertermixin(self):
         path = "django_docx_template/static/django_docx_template/test_image.png"
@@ -111,6 +316,53 @@ class TestImage:
         assert isinstance(img.width, Mm)
         assert isinstance(img.height, Mm)
 
+    def test_sources_share_cached_asset(self):
+        path = "django_docx_template/static/django_docx_template/test_image.png"
+        content = open(path, "rb").read()
+        from_path = data_sources.Image(path).get_asset()
+        assert data_sources.Image(path).get_asset() is from_path
+        from_bytes = data_sources.Image(content).get_asset()
+        assert from_bytes is data_sources.Image(BytesIO(content)).get_asset()
+        assert from_bytes.sha1 == from_path.sha1
+        assert from_bytes.image.px_width == from_path.image.px_width
+
+    def test_storage_file(self):
+        from django.core.files.storage import FileSystemStorage
+
+        storage = FileSystemStorage(location="django_docx_template/static")
+        image_file = File(None, name="django_docx_template/test_image.png")
+        image_file.storage = storage
+        img = data_sources.Image(image_file)
+        assert img.get_asset().image.px_width == 360
+        assert img.cache_key[:3] == (
+            "storage",
+            "django.core.files.storage.filesystem.FileSystemStorage",
+            "django_docx_template/test_image.png",
+        )
+
+    def test_replaced_file_loaded_again(self, tmp_path):
+        path = tmp_path / "image.png"
+        path.write_bytes(benchmark.make_png(16))
+        os.utime(path, (1, 1))
+        first = data_sources.Image(path)
+        first_key = first.get_cache_key()
+        path.write_bytes(benchmark.make_png(32))
+        second = data_sources.Image(path)
+        assert second.get_asset().image.px_width == 32
+        assert second.get_cache_key() != first_key
+
+    def test_merged_document_contains_image(self):
+        content = open("django_docx_template/test_doc.docx", "rb").read()
+        template = DocxTemplate(
+            name="Image document",
+            docx=SimpleUploadedFile("template.docx", content),
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        document = zipfile.ZipFile(template.merge())
+        media = [n for n in document.namelist() if n.startswith("word/media/")]
+        assert len(media) == 1
+        assert b"<w:drawing>" in document.read("word/document.xml")
+
     def test_convert(self):
         from docxtpl import InlineImage
         path = "django_docx_template/static/django_docx_template/test_image.png"
@@ -168,8 +420,8 @@ class TestDocxTemplate:
             docx=suf,
             data_source_class="django_docx_template.tests.SimpleDataSource",
         )
-        in_memory_doc = template.merge(item_3="from_keys")
-        assert isinstance(in_memory_doc, BytesIO)
+        document = template.merge(item_3="from_keys")
+        assert zipfile.is_zipfile(document)
 
     def test_merge_with_image(self):
         content = open("django_docx_template/test_doc.docx", "rb").read()
@@ -179,8 +431,1051 @@ class TestDocxTemplate:
             docx=suf,
             data_source_class="django_docx_template.tests.ImageDataSource",
         )
-        in_memory_doc = template.merge(item_3="from_keys")
-        assert isinstance(in_memory_doc, BytesIO)
+        document = template.merge(item_3="from_keys")
+        assert zipfile.is_zipfile(document)
+
+    def test_merge_spooled_to_disk(self, settings, client):
+        template = make_docx_template("Document 0")
+        settings.DJANGO_DOCX_TEMPLATES = {"spool_max_size": 1024}
+        document = template.merge(slug="document-0")
+        # a spooled file only has a name once it is written to disk
+        assert document.name is not None and zipfile.is_zipfile(document)
+        response = client.get(template.get_merge_absolute_url(slug="document-0"))
+        content = b"".join(response.streaming_content)
+        assert int(response["Content-Length"]) == len(content)
+        assert zipfile.is_zipfile(BytesIO(content))
+        settings.DJANGO_DOCX_TEMPLATES = {"spool_max_size": 1024 * 1024}
+        assert template.merge(slug="document-0").name is None
+        settings.DJANGO_DOCX_TEMPLATES = {"spool_max_size": None}
+        assert isinstance(template.merge(slug="document-0"), BytesIO)
+
+    def test_variables_prune_queryset_fields(self, django_assert_num_queries):
+        template = DocxTemplate(
+            name="Pruned document",
+            docx=SimpleUploadedFile("template.docx", make_docx("{{ name }} {{ x.y }}")),
+            data_source_class="django_docx_template.tests.PrunedTemplateDataSource",
+        )
+        template.save()
+        assert template.variables == ["name", "x"]
+        data_source = template.data_source
+        assert data_source.get_queryset_fields() == (("name",), {})
+        with django_assert_num_queries(1):
+            context = data_source.get_context_data(slug=template.slug)
+        assert context == {"name": "Pruned document"}
+        # unknown variables: every field is fetched
+        template.variables = None
+        fields, expressions = template.data_source.get_queryset_fields()
+        assert fields == ("name",) and set(expressions) == {"file_name"}
+
+    def test_pruning_is_opt_in(self):
+        template = DocxTemplate(
+            name="Unpruned document",
+            docx=SimpleUploadedFile("template.docx", make_docx("{{ name }}")),
+            data_source_class="django_docx_template.tests.TemplateDataSource",
+        )
+        template.save()
+        context = template.data_source.get_context_data(slug=template.slug)
+        assert context == {"name": "Unpruned document", "file_name": template.docx.name}
+
+    def test_no_variable_used(self, django_assert_num_queries):
+        template = DocxTemplate(
+            name="Static document",
+            docx=SimpleUploadedFile("template.docx", make_docx("No tags")),
+            data_source_class="django_docx_template.tests.PrunedTemplateDataSource",
+        )
+        template.save()
+        assert template.variables == []
+        with django_assert_num_queries(1) as queries:
+            context = template.data_source.get_context_data(slug=template.slug)
+        assert context == {}
+        assert '"name"' not in queries.captured_queries[0]["sql"]
+        with django_assert_num_queries(1):
+            contexts = list(
+                template.data_source.get_context_data_many([{"slug": template.slug}])
+            )
+        assert contexts == [({"slug": template.slug}, {})]
+
+
+@pytest.mark.django_db
+class TestRelatedListField:
+    @pytest.fixture
+    def users(self):
+        staff = Group.objects.create(name="Staff")
+        admin = Group.objects.create(name="Admin")
+        users = [User.objects.create(username=f"user{i}") for i in range(3)]
+        users[0].groups.add(staff, admin)
+        users[1].groups.add(staff)
+        return users
+
+    def test_get_context_data(self, users, django_assert_num_queries):
+        data_source = UserDataSource("django_docx_template.tests.UserDataSource")
+        assert data_source.get_queryset_fields() == (("username",), {})
+        with django_assert_num_queries(2):
+            context = data_source.get_context_data(pk=users[0].pk)
+        assert context == {
+            "username": "user0",
+            "groups": [{"group": "Staff"}, {"group": "Admin"}],
+        }
+
+    def test_get_context_data_many(self, users, django_assert_num_queries):
+        data_source = UserDataSource("django_docx_template.tests.UserDataSource")
+        url_kwargs_list = [{"pk": user.pk} for user in reversed(users)]
+        with django_assert_num_queries(2):
+            contexts = list(data_source.get_context_data_many(url_kwargs_list))
+        assert [context["groups"] for _url_kwargs, context in contexts] == [
+            [],
+            [{"group": "Staff"}],
+            [{"group": "Staff"}, {"group": "Admin"}],
+        ]
+
+    def test_unused_field(self, users, django_assert_num_queries):
+        data_source = UserDataSource("django_docx_template.tests.UserDataSource")
+        data_source.prune_fields = True
+        data_source.used_variables = ["username"]
+        with django_assert_num_queries(1):
+            context = data_source.get_context_data(pk=users[0].pk)
+        assert context == {"username": "user0"}
+
+    def test_merge(self, users):
+        template = DocxTemplate(
+            name="Groups",
+            docx=SimpleUploadedFile(
+                "template.docx",
+                make_docx("{% for g in groups %}[{{ g.group }}]{% endfor %}"),
+            ),
+            data_source_class="django_docx_template.tests.UserDataSource",
+        )
+        document = template.merge(pk=users[0].pk)
+        assert b"[Staff][Admin]" in zipfile.ZipFile(document).read("word/document.xml")
+        assert template.merge_example(0)
+
+
+@pytest.mark.django_db
+class TestMergeMany:
+    def test_get_context_data_many(self, django_assert_num_queries):
+        for i in range(5):
+            make_docx_template(f"Document {i}")
+        ds = TemplateDataSource("django_docx_template.tests.TemplateDataSource")
+        url_kwargs_list = [{"slug": f"document-{i}"} for i in (3, 1, 9, 0, 4)]
+        with django_assert_num_queries(2):
+            contexts = list(ds.get_context_data_many(url_kwargs_list, chunk_size=3))
+        assert [kwargs for kwargs, _ in contexts] == url_kwargs_list
+        assert contexts[0][1] == ds.get_context_data(slug="document-3")
+        assert contexts[1][1]["name"] == "Document 1"
+        assert contexts[2][1] is None
+
+    def test_get_context_data_many_fallback(self):
+        ds = ImageDataSource("django_docx_template.tests.ImageDataSource")
+        contexts = list(ds.get_context_data_many([{"a": 1}, {"a": 2}]))
+        assert len(contexts) == 2
+        assert contexts[1][1]["first_name"] == "First Name"
+
+    def test_merge_many(self, django_assert_num_queries):
+        for i in range(3):
+            template = make_docx_template(f"Document {i}")
+        url_kwargs_list = [{"slug": f"document-{i}"} for i in range(4)]
+        documents = template.merge_many(url_kwargs_list)
+        with django_assert_num_queries(1):
+            url_kwargs, document = next(documents)
+        assert url_kwargs == {"slug": "document-0"}
+        assert zipfile.is_zipfile(document)
+        documents = list(documents)
+        assert len(documents) == 3
+        assert documents[-1] == ({"slug": "document-3"}, None)
+
+    def test_get_bulk_url_kwargs(self):
+        for i in range(2):
+            make_docx_template(f"Document {i}")
+        ds = TemplateDataSource("django_docx_template.tests.TemplateDataSource")
+        query_dict = QueryDict("slug=document-1&slug=document-0")
+        url_kwargs_list = ds.get_bulk_url_kwargs(query_dict)
+        assert url_kwargs_list == [{"slug": "document-1"}, {"slug": "document-0"}]
+        query_dict = QueryDict(f"data_source_class={ds.class_path}")
+        assert len(list(ds.get_bulk_url_kwargs(query_dict))) == 2
+        with pytest.raises(ValueError):
+            ds.get_bulk_url_kwargs(QueryDict("unknown=1"))
+
+    def test_get_bulk_url_kwargs_invalid(self):
+        class VersionDataSource(TemplateDataSource):
+            url_args = {"slug": "slug", "version": "int"}
+            bulk_filter_args = {"data_source_class": "unknown"}
+
+        ds = VersionDataSource("django_docx_template.tests.TemplateDataSource")
+        query_dict = QueryDict("slug=document-0&slug=document-1&version=1")
+        with pytest.raises(ValueError, match="same number of times"):
+            ds.get_bulk_url_kwargs(query_dict)
+        with pytest.raises(ValueError, match="Unknown url argument type"):
+            ds.get_bulk_url_kwargs(QueryDict("data_source_class=x"))
+
+    def test_bulk_merge_view(self, rf):
+        for i in range(3):
+            make_docx_template(f"Document {i}")
+        request = rf.get("/", {"slug": ["document-0", "document-2", "missing"]})
+        response = views.TemplateBulkMergeView.as_view()(request, slug="document-0")
+        assert response.streaming
+        archive = zipfile.ZipFile(BytesIO(b"".join(response.streaming_content)))
+        names = ["Document_0_document-0.docx", "Document_0_document-2.docx"]
+        assert archive.namelist() == names
+        assert zipfile.is_zipfile(BytesIO(archive.read(names[1])))
+        response = views.TemplateBulkMergeView.as_view()(rf.get("/"), slug="document-0")
+        assert response.status_code == 400
+
+
+@pytest.mark.django_db
+class TestExecutors:
+    @pytest.fixture
+    def template(self):
+        return make_docx_template(
+            "Executed document",
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+
+    def render(self, executor, template):
+        context = ImageDataSource("").get_context_data()
+        items = [(i, None if i == 2 else dict(context)) for i in range(5)]
+        results = list(executor.render(template, items))
+        executor.shutdown()
+        assert [key for key, _ in results] == list(range(5))
+        assert results[2][1] is None
+        assert all(zipfile.is_zipfile(buffer) for _, buffer in results if buffer)
+
+    def test_serial(self, template):
+        self.render(executors.build_executor(), template)
+
+    def test_thread(self, template):
+        executor = executors.build_executor("thread", max_workers=2, max_in_flight=2)
+        self.render(executor, template)
+
+    def test_process(self, template):
+        executor = executors.build_executor("process", max_workers=2)
+        self.render(executor, template)
+
+    def test_process_file_like_image(self, tmp_path):
+        template = make_docx_template("Image document", make_docx("{{ image }}"))
+        path = tmp_path / "image.png"
+        path.write_bytes(benchmark.make_png(64))
+        executor = executors.build_executor("process", max_workers=1)
+        with open(path, "rb") as image_file:
+            image = data_sources.Image(File(image_file), width=20)
+            results = list(executor.render(template, [(0, {"image": image})]))
+        executor.shutdown()
+        names = zipfile.ZipFile(results[0][1]).namelist()
+        assert "word/media/image1.png" in names
+
+    def test_unknown_backend(self):
+        with pytest.raises(ImproperlyConfigured):
+            executors.build_executor("not.an.executor")
+
+
+@pytest.mark.django_db
+class TestAsyncMerge:
+    def test_aget_context_data(self):
+        for i in range(2):
+            make_docx_template(f"Document {i}")
+        ds = TemplateDataSource("django_docx_template.tests.TemplateDataSource")
+        context = async_to_sync(ds.aget_context_data)(slug="document-1")
+        assert context == ds.get_context_data(slug="document-1")
+
+    def test_aget_context_data_fallback(self):
+        ds = ImageDataSource("django_docx_template.tests.ImageDataSource")
+        context = async_to_sync(ds.aget_context_data)()
+        assert context["first_name"] == "First Name"
+
+    def test_async_merge_view(self, rf):
+        make_docx_template("Document 0")
+        view = views.AsyncTemplateMergeView.as_view()
+        request = rf.get("/")
+        response = async_to_sync(view)(
+            request, slug="document-0", url_args="document-0"
+        )
+        assert response.status_code == 200
+        assert zipfile.is_zipfile(BytesIO(b"".join(response.streaming_content)))
+        with pytest.raises(Http404):
+            async_to_sync(view)(request, slug="unknown", url_args="document-0")
+
+    def test_etag_out_of_event_loop(self, rf, monkeypatch):
+        import asyncio
+
+        make_docx_template("Document 0")
+        get_etag = DocxTemplate.get_etag
+        on_loop = []
+
+        def record_get_etag(template, context):
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                on_loop.append(False)
+            else:
+                on_loop.append(True)
+            return get_etag(template, context)
+
+        monkeypatch.setattr(DocxTemplate, "get_etag", record_get_etag)
+        view = views.AsyncTemplateMergeView.as_view()
+        async_to_sync(view)(rf.get("/"), slug="document-0", url_args="document-0")
+        assert on_loop == [False]
+
+
+class TestTemplateCache:
+    def make_entry(self, size):
+        return CachedTemplate(document=None, size=size)
+
+    def test_lru_eviction(self):
+        cache = TemplateCache(max_entries=2)
+        cache.set(("a", 1), self.make_entry(10))
+        cache.set(("b", 1), self.make_entry(10))
+        cache.get(("a", 1))
+        cache.set(("c", 1), self.make_entry(10))
+        assert ("a", 1) in cache
+        assert ("b", 1) not in cache
+        assert ("c", 1) in cache
+
+    def test_bytes_budget(self):
+        cache = TemplateCache(max_bytes=25)
+        cache.set(("a", 1), self.make_entry(10))
+        cache.set(("b", 1), self.make_entry(10))
+        cache.set(("c", 1), self.make_entry(10))
+        assert len(cache) == 2
+        assert cache.current_bytes == 20
+        cache.set(("d", 1), self.make_entry(30))
+        assert ("d", 1) not in cache
+
+    def test_invalidate(self):
+        cache = TemplateCache()
+        cache.set(("a", 1), self.make_entry(10))
+        cache.set(("a", 2), self.make_entry(10))
+        cache.set(("b", 1), self.make_entry(10))
+        cache.invalidate("a")
+        assert len(cache) == 1
+        assert cache.current_bytes == 10
+
+    def test_clone_is_independent(self):
+        content = open("django_docx_template/test_doc.docx", "rb").read()
+        entry = CachedTemplate.from_bytes(content)
+        assert entry.size > len(content)
+        clone = entry.clone()
+        clone.add_paragraph("only in the clone")
+        assert len(clone.paragraphs) == len(entry.document.paragraphs) + 1
+
+    @pytest.mark.django_db
+    def test_merge_uses_cache(self):
+        content = open("django_docx_template/test_doc.docx", "rb").read()
+        suf = SimpleUploadedFile("template.docx", content)
+        template = DocxTemplate(
+            name="Cached document",
+            docx=suf,
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        template.save()
+        cache = get_template_cache()
+        key = (template.slug, template.get_file_version())
+        template.merge()
+        assert key in cache
+        assert zipfile.is_zipfile(template.merge())
+        template.save()
+        assert key not in cache
+
+
+@pytest.mark.django_db
+class TestContentHash:
+    def test_without_file(self):
+        template = DocxTemplate.objects.create(
+            name="No file",
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        assert template.content_hash == "" and template.version == 0
+
+    def test_missing_stored_file(self):
+        template = make_docx_template("Lost document", make_docx("Hi"))
+        template.docx.storage.delete(template.docx.name)
+        DocxTemplate.objects.filter(pk=template.pk).update(content_hash="")
+        template = DocxTemplate.objects.get(pk=template.pk)
+        template.save()
+        assert template.content_hash == "" and template.version == 1
+        assert DocxTemplate.objects.get(pk=template.pk).content_hash == ""
+
+    def test_version(self):
+        content = make_docx("Hi {{ first_name }}")
+        template = make_docx_template("Versioned document", content)
+        assert template.content_hash == hashlib.sha256(content).hexdigest()
+        assert template.version == 1
+        assert template.content_modified_at is not None
+        assert template.get_file_version() == template.content_hash
+        etag = template.get_etag({"first_name": "Ann"})
+
+        template.docx = SimpleUploadedFile("template.docx", make_docx("Bye"))
+        template.save()
+        assert template.version == 2
+        assert template.get_file_version() != hashlib.sha256(content).hexdigest()
+        assert template.get_etag({"first_name": "Ann"}) != etag
+        assert DocxTemplate.objects.get(slug=template.slug).version == 2
+
+    def test_identical_uploads_deduplicated(self):
+        content = make_docx("Hi {{ first_name }}")
+        template = make_docx_template("Deduplicated document", content)
+        name = template.docx.name
+        template.docx = SimpleUploadedFile("other name.docx", content)
+        template.save()
+        assert template.docx.name == name
+        assert template.version == 1
+
+        other = make_docx_template("Same document", content)
+        assert other.docx.name == name
+        assert other.get_file_version() == template.get_file_version()
+        assert other.merge().read(2) == b"PK"
+
+
+@pytest.mark.django_db
+class TestMergeJob:
+    def test_run_jobs(self):
+        for i in range(2):
+            template = make_docx_template(f"Document {i}")
+        job = template.enqueue_merge(slug="document-0")
+        bulk_job = template.enqueue_merge_many(
+            [{"slug": "document-0"}, {"slug": "document-1"}]
+        )
+        assert MergeJob.claim() == job
+        assert MergeJob.claim() == bulk_job
+        assert MergeJob.claim() is None
+        job.run()
+        bulk_job.run()
+        job.refresh_from_db()
+        assert job.status == MergeJob.DONE and job.finished_at
+        with job.result.open("rb") as result:
+            assert zipfile.is_zipfile(result)
+        with bulk_job.result.open("rb") as result:
+            assert zipfile.ZipFile(result).namelist() == [
+                "Document_1_document-0.docx",
+                "Document_1_document-1.docx",
+            ]
+
+    def test_failed_job(self):
+        template = make_docx_template("Document 0")
+        template.data_source_class = "django_docx_template.tests.SimpleDataSource"
+        template.save()
+        job = template.enqueue_merge(item="value")
+        MergeJob.claim().run()
+        job.refresh_from_db()
+        assert job.status == MergeJob.FAILED
+        assert "ImproperlyConfigured" in job.error
+
+    def test_bulk_job_with_uuid_url_args(self):
+        import uuid
+
+        template = make_docx_template(
+            "Job document",
+            make_docx("{{ status }}"),
+            data_source_class="django_docx_template.tests.JobDataSource",
+        )
+        done_job = template.enqueue_merge(id=uuid.uuid4())
+        MergeJob.objects.filter(pk=done_job.pk).update(status=MergeJob.DONE)
+        missing = uuid.uuid4()
+        job = template.enqueue_merge_many([{"id": done_job.pk}, {"id": missing}])
+        MergeJob.claim().run()
+        job.refresh_from_db()
+        assert job.status == MergeJob.DONE
+        assert job.skipped == [{"id": str(missing)}]
+        with job.result.open("rb") as result:
+            names = zipfile.ZipFile(result).namelist()
+        assert names == [f"Job_document_{done_job.pk}.docx"]
+
+        empty_job = template.enqueue_merge_many([{"id": missing}])
+        MergeJob.claim().run()
+        empty_job.refresh_from_db()
+        assert empty_job.status == MergeJob.FAILED
+        assert "No data found" in empty_job.error
+
+    def test_lost_job_claimed_again(self, settings):
+        settings.DJANGO_DOCX_TEMPLATES = {"job_timeout": 60, "job_max_attempts": 2}
+        template = make_docx_template("Document 0")
+        job = template.enqueue_merge(slug="document-0")
+        assert MergeJob.claim() == job
+        assert MergeJob.claim() is None
+        lost_at = datetime.datetime.now(datetime.timezone.utc)
+        lost_at -= datetime.timedelta(seconds=61)
+        MergeJob.objects.update(started_at=lost_at)
+        job = MergeJob.claim()
+        assert job.attempts == 2
+        MergeJob.objects.update(started_at=lost_at)
+        assert MergeJob.claim() is None
+        job.refresh_from_db()
+        assert job.status == MergeJob.FAILED
+        assert "Worker lost" in job.error
+
+    def test_delete_expired(self, settings):
+        settings.DJANGO_DOCX_TEMPLATES = {"job_retention": 3600}
+        template = make_docx_template("Document 0")
+        jobs = [template.enqueue_merge(slug="document-0") for _ in range(2)]
+        for _ in jobs:
+            MergeJob.claim().run()
+        finished_at = datetime.datetime.now(datetime.timezone.utc)
+        finished_at -= datetime.timedelta(seconds=3601)
+        MergeJob.objects.filter(pk=jobs[0].pk).update(finished_at=finished_at)
+        jobs[0].refresh_from_db()
+        storage, name = jobs[0].result.storage, jobs[0].result.name
+        assert storage.exists(name)
+        assert MergeJob.delete_expired() == 1
+        assert not storage.exists(name)
+        assert list(MergeJob.objects.all()) == [jobs[1]]
+
+    def test_status_and_download_views(self, client):
+        template = make_docx_template("Document 0")
+        job = template.enqueue_merge(slug="document-0")
+        status_url = reverse("docx_template:job-status", kwargs={"pk": job.pk})
+        assert client.get(status_url).json()["status"] == "pending"
+        download_url = reverse("docx_template:job-download", kwargs={"pk": job.pk})
+        assert client.get(download_url).status_code == 404
+        MergeJob.claim().run()
+        data = client.get(status_url).json()
+        assert data["status"] == "done" and data["download_url"] == download_url
+        response = client.get(download_url)
+        assert response.status_code == 200
+        assert "Document_0_document-0.docx" in response["Content-Disposition"]
+
+
+@pytest.mark.django_db
+class TestConditionalMerge:
+    def test_etag(self, client, monkeypatch):
+        template = make_docx_template("Document 0")
+        url = template.get_merge_absolute_url(slug="document-0")
+        response = client.get(url)
+        etag = response["ETag"]
+        assert response.status_code == 200 and etag
+        assert client.get(url)["ETag"] == etag
+
+        def fail(*args, **kwargs):
+            raise AssertionError("rendered")
+
+        monkeypatch.setattr(DocxTemplate, "_merge", fail)
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert response["ETag"] == etag
+        DocxTemplate.objects.filter(slug="document-0").update(name="Renamed")
+        with pytest.raises(AssertionError):
+            client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_last_modified(self, client, monkeypatch):
+        template = make_docx_template("Document 0")
+        template.data_source_class = "django_docx_template.tests.ModifiedDataSource"
+        template.save()
+        url = template.get_merge_absolute_url(slug="document-0")
+        response = client.get(url)
+        last_modified = response["Last-Modified"]
+        assert response.status_code == 200 and "ETag" not in response
+
+        def fail(*args, **kwargs):
+            raise AssertionError("context fetched")
+
+        monkeypatch.setattr(ModifiedDataSource, "get_context_data", fail)
+        response = client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert response.status_code == 304
+
+
+@pytest.mark.django_db
+class TestWarmup:
+    def test_preload(self):
+        get_template_cache().clear()
+        for i in range(2):
+            template = make_docx_template(f"Document {i}")
+        DocxTemplate.objects.filter(slug="document-0").update(
+            data_source_class="unknown.DataSource"
+        )
+        reports = warmup.preload(measure_memory=True)
+        assert [report["slug"] for report in reports] == ["document-0", "document-1"]
+        assert "Unknow DataSource" in reports[0]["error"]
+        assert reports[1]["error"] is None and reports[1]["memory"] > 0
+        key = (template.slug, template.get_file_version())
+        compiled = get_template_cache().get(key).compiled
+        assert "body" in compiled[engine.get_jinja_env()]
+
+    def test_warm_up_without_query(self, django_assert_num_queries):
+        template = make_docx_template("Document 0")
+        routing.router.invalidate()
+        with django_assert_num_queries(0):
+            warmup.warm_up(template)
+        assert routing.router.resolve(template.slug, "document-0")
+
+    def test_preload_on_ready_without_database(self, monkeypatch):
+        def preload():
+            raise DatabaseError("no such table")
+
+        monkeypatch.setattr(warmup, "preload", preload)
+        warmup.preload_on_ready()
+
+    def test_no_preload_in_executor_workers(self, monkeypatch):
+        def preload():
+            raise AssertionError("preloaded in a worker")
+
+        monkeypatch.setattr(warmup, "preload", preload)
+        monkeypatch.setattr(executors, "_in_worker", False)
+        executors.init_worker()
+        assert executors.in_worker()
+        warmup.preload_on_ready()
+
+    def test_command(self):
+        make_docx_template("Document 0")
+        stdout = StringIO()
+        call_command("docx_warmup", "document-0", stdout=stdout)
+        assert stdout.getvalue().startswith("document-0")
+        assert "1 template(s)" in stdout.getvalue()
+
+
+recorded_metrics = []
+
+
+def record_metrics(metrics):
+    recorded_metrics.append(metrics)
+
+
+@pytest.mark.django_db
+class TestMetrics:
+    def test_disabled(self):
+        template = make_docx_template("Document 0")
+        assert metrics.start_metrics(template) is None
+        template.merge(slug="document-0")
+        assert template.last_merge_metrics is None
+
+    def test_merge_finished_signal(self):
+        template = make_docx_template("Document 0")
+        received = []
+
+        def receiver(sender, template, metrics, **kwargs):
+            received.append(metrics)
+
+        metrics.merge_finished.connect(receiver)
+        try:
+            document = template.merge(slug="document-0")
+        finally:
+            metrics.merge_finished.disconnect(receiver)
+        merge_metrics = received[0]
+        assert template.last_merge_metrics is merge_metrics
+        assert list(merge_metrics.timings) == ["context", "load", "render", "save"]
+        assert merge_metrics.queries == 1
+        assert merge_metrics.size == len(document.read())
+
+    def test_backend(self, settings, monkeypatch):
+        monkeypatch.setattr(metrics, "_metrics_backend", None)
+        settings.DJANGO_DOCX_TEMPLATES = {
+            "metrics_backend": "django_docx_template.tests.record_metrics"
+        }
+        recorded_metrics.clear()
+        template = make_docx_template("Document 0")
+        template.merge(slug="document-0")
+        assert recorded_metrics[0].slug == template.slug
+        assert recorded_metrics[0].as_dict()["total"] > 0
+
+    def test_server_timing_header(self, client, settings):
+        template = make_docx_template("Document 0")
+        url = template.get_merge_absolute_url(slug="document-0")
+        assert "Server-Timing" not in client.get(url)
+        settings.DJANGO_DOCX_TEMPLATES = {"server_timing": True}
+        server_timing = client.get(url)["Server-Timing"]
+        assert "validators;dur=" in server_timing
+        assert "render;dur=" in server_timing
+        assert 'db;desc="1 queries"' in server_timing
+
+
+class TestBenchmark:
+    def test_run(self):
+        scenarios = {"tiny": {"pages": 2, "tags": 3, "rows": 2, "images": 1}}
+        results = benchmark.run(
+            scenarios=scenarios, repeat=1, data_source_sizes=[(3, 2)]
+        )
+        stages = [f"merge/tiny/{stage}" for stage in benchmark.STAGES]
+        assert set(stages + ["merge/tiny/total"]) <= set(results)
+        assert "data_source/3x2/example_combinations" in results
+
+    def test_compare(self):
+        baseline = {"fast": 0.0001, "stable": 0.1, "slower": 0.1, "removed": 1.0}
+        results = {"fast": 0.0009, "stable": 0.11, "slower": 0.2}
+        assert benchmark.compare(results, baseline, threshold=0.2) == [
+            ("slower", 0.1, 0.2)
+        ]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_docx_worker_command():
+    template = make_docx_template("Document 0")
+    for _ in range(2):
+        template.enqueue_merge(slug="document-0")
+    stdout = StringIO()
+    call_command("docx_worker", once=True, stdout=stdout)
+    assert [job.status for job in MergeJob.objects.all()] == [MergeJob.DONE] * 2
+    assert stdout.getvalue().count("done") == 2
+
+
+@pytest.mark.django_db
+class TestRouting:
+    def test_resolve(self, django_assert_num_queries):
+        make_docx_template(
+            "Routed document",
+            data_source_class="django_docx_template.tests.ManyExamplesDataSource",
+        )
+        router = routing.MergeRouter()
+        with django_assert_num_queries(1):
+            assert router.resolve("routed-document", "12") == {"pk": 12}
+            assert router.resolve("routed-document", "12/13") is None
+            assert router.resolve("routed-document", "not-an-int") is None
+        assert router.resolve("unknown", "12") is None
+
+    def test_invalidated_by_signals(self):
+        template = make_docx_template(
+            "Routed document",
+            data_source_class="django_docx_template.tests.ManyExamplesDataSource",
+        )
+        assert routing.router.resolve(template.slug, "12") == {"pk": 12}
+        template.data_source_class = "django_docx_template.tests.ImageDataSource"
+        template.save()
+        assert routing.router.resolve(template.slug, "") == {}
+        template.delete()
+        assert routing.router.resolve(template.slug, "") is None
+
+    def test_merge_view(self, rf):
+        template = make_docx_template(
+            "Routed document",
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        view = views.TemplateMergeView.as_view()
+        response = view(rf.get("/"), slug=template.slug)
+        assert response.status_code == 200
+        with pytest.raises(Http404):
+            view(rf.get("/"), slug=template.slug, url_args="12")
+
+    def test_route_built_from_loaded_template(self, django_assert_num_queries):
+        template = make_docx_template(
+            "Routed document",
+            data_source_class="django_docx_template.tests.ManyExamplesDataSource",
+        )
+        routing.router.invalidate()
+        view = views.TemplateMergeView(kwargs={"url_args": "12"})
+        with django_assert_num_queries(0):
+            assert view.get_merge_kwargs(template) == {"pk": 12}
+
+    def test_reverse_merge(self):
+        template = make_docx_template(
+            "Routed document",
+            data_source_class="django_docx_template.tests.ManyExamplesDataSource",
+        )
+        url = template.get_merge_absolute_url(pk=12)
+        assert url.endswith("templates/merge/routed-document/12")
+        match = resolve(url)
+        assert match.url_name == "merge"
+        assert match.kwargs == {"slug": "routed-document", "url_args": "12"}
+
+
+class TestOutputCache:
+    def test_filesystem_backend_lru(self, tmp_path):
+        backend = FileSystemBackend(tmp_path, max_bytes=25)
+        backend.set("a", BytesIO(b"a" * 10))
+        backend.set("b", BytesIO(b"b" * 10))
+        os.utime(tmp_path / "a.docx", (1, 1))
+        os.utime(tmp_path / "b.docx", (2, 2))
+        with backend.get("a") as document:
+            assert document.read() == b"a" * 10
+        backend.set("c", BytesIO(b"c" * 10))
+        assert backend.get("b") is None
+        assert backend.get("a") is not None
+        assert backend.get("missing") is None
+
+    def test_django_backend(self):
+        backend = DjangoCacheBackend(key_prefix="test_output")
+        buffer = BytesIO(b"document")
+        backend.set("a", buffer)
+        assert buffer.tell() == 0
+        assert backend.get("a").read() == b"document"
+        assert backend.get("b") is None
+
+    def test_context_digest(self):
+        path = "django_docx_template/static/django_docx_template/test_image.png"
+        context = {"b": [1, datetime.date(2022, 1, 1)], "a": data_sources.Image(path)}
+        digest = utils.context_digest(context)
+        assert digest == utils.context_digest(dict(reversed(context.items())))
+        assert digest != utils.context_digest({**context, "c": 1})
+        assert utils.context_digest({"a": object()}) is None
+
+    @pytest.mark.django_db
+    def test_merge_hit_skips_rendering(self, monkeypatch):
+        monkeypatch.setattr(cache, "_output_cache", DjangoCacheBackend())
+        template = make_docx_template(
+            "Routed document",
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        document = template.merge().read()
+
+        def fail(*args, **kwargs):
+            raise AssertionError("document rendered again")
+
+        monkeypatch.setattr(template, "_merge", fail)
+        assert template.merge().read() == document
+
+
+class CountingStorage(FileSystemStorage):
+    """Local storage counting downloads, standing for a remote one."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.downloads = 0
+
+    def _open(self, name, mode="rb"):
+        self.downloads += 1
+        return super()._open(name, mode)
+
+
+@pytest.mark.django_db
+class TestLocalMirror:
+    def test_read_through(self, tmp_path, monkeypatch, settings):
+        monkeypatch.setattr(cache, "_local_mirror", None)
+        settings.DJANGO_DOCX_TEMPLATES = {"local_mirror": {"location": tmp_path}}
+        template = make_docx_template(
+            "Mirrored document", make_docx("Hi {{ first_name }}")
+        )
+        storage = CountingStorage(location=settings.MEDIA_ROOT)
+        template.docx.storage = storage
+        template._load_template()
+        cached = template._load_template()
+        assert storage.downloads == 1
+        assert (tmp_path / f"{template.content_hash}.docx").exists()
+        document = template._merge({"first_name": "Ann"}, cached=cached)
+        assert b"Hi Ann" in zipfile.ZipFile(document).read("word/document.xml")
+
+    def test_changed_file_not_mirrored(self, tmp_path):
+        mirror = cache.LocalMirror(tmp_path)
+        template = make_docx_template("Changed file", make_docx("Hi"))
+        content = mirror.read(template.docx, "0" * 64)
+        assert content[:2] == b"PK"
+        assert list(tmp_path.iterdir()) == []
+
+
+def shout(value):
+    return str(value).upper()
+
+
+def make_docx(*paragraphs):
+    """Return the content of a docx holding paragraphs."""
+    from docx import Document
+
+    document = Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    buffer = BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def make_docx_template(
+    name,
+    content=None,
+    data_source_class="django_docx_template.tests.TemplateDataSource",
+):
+    """Return a saved DocxTemplate whose file is content, test_doc.docx by
+    default."""
+    if content is None:
+        content = open("django_docx_template/test_doc.docx", "rb").read()
+    template = DocxTemplate(
+        name=name,
+        docx=SimpleUploadedFile("template.docx", content),
+        data_source_class=data_source_class,
+    )
+    template.save()
+    return template
+
+
+class TestEngine:
+    def test_templates_compiled_once(self, monkeypatch):
+        template = DocxTemplate(
+            name="Compiled document",
+            docx=SimpleUploadedFile("template.docx", make_docx("Hi {{ first_name }}")),
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        cached = template._get_cached_template()
+        template._merge({"first_name": "Ann"}, cached=cached)
+        compiled = dict(cached.compiled[engine.get_jinja_env()])
+        assert "body" in compiled
+
+        def fail(*args, **kwargs):
+            raise AssertionError("compiled again")
+
+        monkeypatch.setattr(engine.DocxEngine, "patch_xml", fail)
+        document = template._merge({"first_name": "Bob"}, cached=cached)
+        assert cached.compiled[engine.get_jinja_env()] == compiled
+        assert b"Hi Bob" in zipfile.ZipFile(document).read("word/document.xml")
+
+    def test_templates_compiled_by_environment(self):
+        from jinja2 import Environment
+
+        template = DocxTemplate(
+            name="Escaped document",
+            docx=SimpleUploadedFile("template.docx", make_docx("Hi {{ first_name }}")),
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        cached = template._load_template()
+
+        def render(first_name, **kwargs):
+            docx_engine = engine.DocxEngine(template.docx, compiled=cached.compiled)
+            docx_engine.render({"first_name": first_name}, **kwargs)
+            return docx_engine.get_xml()
+
+        assert "Hi Ann" in render("Ann")
+        assert "Hi Ann &amp; Bob" in render("Ann & Bob", autoescape=True)
+        assert not engine.get_jinja_env().autoescape
+        assert "Hi ANN" in render("Ann", jinja_env=Environment(finalize=shout))
+        assert len(cached.compiled) == 3
+
+    def test_template_error_context(self):
+        from jinja2 import TemplateSyntaxError
+
+        template = DocxTemplate(
+            name="Broken document",
+            docx=SimpleUploadedFile(
+                "template.docx", make_docx("Hi", "{{ first_name }", "Bye")
+            ),
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        with pytest.raises(TemplateSyntaxError) as exc_info:
+            template._merge({"first_name": "Ann"})
+        assert "{{ first_name }" in "".join(exc_info.value.docx_context)
+
+    def test_custom_filters(self, settings, monkeypatch):
+        monkeypatch.setattr(engine, "_jinja_env", None)
+        settings.DJANGO_DOCX_TEMPLATES = {
+            "jinja_filters": {"shout": "django_docx_template.tests.shout"},
+        }
+        template = DocxTemplate(
+            name="Filtered document",
+            docx=SimpleUploadedFile("template.docx", make_docx("{{ name|shout }}")),
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        document = template._merge({"name": "quiet"})
+        assert b"QUIET" in zipfile.ZipFile(document).read("word/document.xml")
+
+    def test_static_parts_not_rendered(self, monkeypatch):
+        from docx import Document
+
+        document = Document()
+        document.add_paragraph("Hi {{ first_name }}")
+        section = document.sections[0]
+        section.different_first_page_header_footer = True
+        section.header.paragraphs[0].text = "Page of {{ first_name }}"
+        section.first_page_header.paragraphs[0].text = "Static first page"
+        section.footer.paragraphs[0].text = "Static footer"
+        document.core_properties.title = "Letter to {{ first_name }}"
+        buffer = BytesIO()
+        document.save(buffer)
+        template = DocxTemplate(
+            name="Static parts",
+            docx=SimpleUploadedFile("template.docx", buffer.getvalue()),
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        cached = template._load_template(normalize=True)
+        mapped = []
+        map_headers_footers_xml = engine.DocxEngine.map_headers_footers_xml
+
+        def record_map(docx_engine, rel_key, xml):
+            mapped.append(xml)
+            return map_headers_footers_xml(docx_engine, rel_key, xml)
+
+        monkeypatch.setattr(engine.DocxEngine, "map_headers_footers_xml", record_map)
+        merged = template._merge({"first_name": "Ann"}, cached=cached)
+        assert len(mapped) == 1
+        assert b"Page of Ann" in mapped[0]
+
+        # once compiled, rendering doesn't serialize headers and footers
+        from docx.opc import part as opc_part
+
+        serialized = []
+        serialize_part_xml = opc_part.serialize_part_xml
+
+        def record_serialize(element):
+            serialized.append(element.tag.rsplit("}", 1)[-1])
+            return serialize_part_xml(element)
+
+        monkeypatch.setattr(opc_part, "serialize_part_xml", record_serialize)
+        docx_engine = template._load_engine(cached)
+        docx_engine.render({"first_name": "Bob"})
+        assert "hdr" not in serialized and "ftr" not in serialized
+
+        # static parts are written as they are in the template
+        source = zipfile.ZipFile(BytesIO(cached.source.content))
+        merged_zip = zipfile.ZipFile(merged)
+        static_parts = [
+            name
+            for name in source.namelist()
+            if name.startswith(("word/header", "word/footer"))
+            and b"{{" not in source.read(name)
+        ]
+        assert len(static_parts) == 2
+        for name in static_parts:
+            assert merged_zip.read(name) == source.read(name)
+
+        merged_document = Document(merged)
+        merged_section = merged_document.sections[0]
+        assert merged_document.core_properties.title == "Letter to Ann"
+        assert merged_section.header.paragraphs[0].text == "Page of Ann"
+        assert merged_section.first_page_header.paragraphs[0].text == (
+            "Static first page"
+        )
+        assert merged_section.footer.paragraphs[0].text == "Static footer"
+
+    def test_unchanged_members_copied_raw(self, monkeypatch):
+        from docx import Document
+
+        document = Document()
+        document.add_paragraph("Hi {{ first_name }}")
+        document.add_picture(BytesIO(benchmark.make_png(64)))
+        buffer = BytesIO()
+        document.save(buffer)
+        template = DocxTemplate(
+            name="Pass-through document",
+            docx=SimpleUploadedFile("template.docx", buffer.getvalue()),
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        cached = template._load_template(normalize=True)
+        source = zipfile.ZipFile(BytesIO(cached.source.content))
+        writestr = zipfile.ZipFile.writestr
+        written = []
+
+        def record_writestr(zipf, name, *args, **kwargs):
+            written.append(name)
+            return writestr(zipf, name, *args, **kwargs)
+
+        monkeypatch.setattr(zipfile.ZipFile, "writestr", record_writestr)
+        merged = zipfile.ZipFile(template._merge({"first_name": "Ann"}, cached=cached))
+        assert merged.testzip() is None
+        assert b"Hi Ann" in merged.read("word/document.xml")
+        assert "word/document.xml" in written
+        for name in ("word/styles.xml", "word/media/image1.png"):
+            assert name not in written
+            assert merged.getinfo(name).CRC == source.getinfo(name).CRC
+            assert merged.read(name) == source.read(name)
+
+    @pytest.mark.parametrize("internal", ["RAW_COPY", "PACKAGE_WRITER"])
+    def test_without_private_internals(self, monkeypatch, internal):
+        monkeypatch.setattr(package, internal, False)
+        template = DocxTemplate(
+            name="Saved document",
+            docx=SimpleUploadedFile("template.docx", make_docx("Hi {{ first_name }}")),
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        cached = template._load_template(normalize=True)
+        merged = zipfile.ZipFile(template._merge({"first_name": "Ann"}, cached=cached))
+        assert merged.testzip() is None
+        assert b"Hi Ann" in merged.read("word/document.xml")
+        assert merged.read("word/styles.xml") == zipfile.ZipFile(
+            BytesIO(cached.source.content)
+        ).read("word/styles.xml")
+
+    def test_new_images_stored(self):
+        template = DocxTemplate(
+            name="Stored images",
+            docx=SimpleUploadedFile("template.docx", make_docx("{{ image }}")),
+            data_source_class="django_docx_template.tests.ImageDataSource",
+        )
+        image = data_sources.Image(benchmark.make_png(64), width=20)
+        cached = template._load_template(normalize=True)
+        document = template._merge({"image": image}, cached=cached)
+        infos = zipfile.ZipFile(document).infolist()
+        media = [info for info in infos if info.filename.startswith("word/media/")]
+        assert media
+        assert all(info.compress_type == zipfile.ZIP_STORED for info in media)
 
 
 class TestUtils:
@@ -190,6 +1485,41 @@ class TestUtils:
         sds = utils.import_from_string(import_str)
         assert isinstance(sds, SimpleDataSource)
 
+    def test_import_from_string_is_memoized(self, monkeypatch):
+        calls = []
+
+        def locate(class_path):
+            calls.append(class_path)
+            return SimpleDataSource
+
+        monkeypatch.setattr(utils, "_data_source_classes", dict())
+        monkeypatch.setattr(utils, "locate", locate)
+        utils.import_from_string("any.class.path")
+        sds = utils.import_from_string("any.class.path")
+        assert isinstance(sds, SimpleDataSource)
+        assert sds.class_path == "any.class.path"
+        assert calls == ["any.class.path"]
+        with pytest.raises(KeyError):
+            utils.import_from_string(None)
+
+    def test_check_data_sources(self, settings):
+        settings.DJANGO_DOCX_TEMPLATES = {
+            "data_sources": [
+                "django_docx_template.tests.SimpleDataSource",
+                "unknown.DataSource",
+            ]
+        }
+        errors = check_data_sources(None)
+        assert [e.msg for e in errors] == ["Unknown DataSource unknown.DataSource"]
+
+    def test_data_source_property(self):
+        template = DocxTemplate(
+            data_source_class="django_docx_template.tests.SimpleDataSource"
+        )
+        assert template.data_source is template.data_source
+        template.data_source_class = "django_docx_template.tests.ImageDataSource"
+        assert isinstance(template.data_source, ImageDataSource)
+
     def test_get_all_data_sources(self, settings):
         data_source_list = {
             "data_sources": [
@@ -1,24 +1,16 @@
 from django.urls import path
 
 from . import views
-from .models import DocxTemplate
+from .utils import get_setting
 
 
 app_name = "docx_template"
 
 
-# Attention, lors de la création d'un template, Django ne connaîtra pas l'url de merge
-# avant le prochain redémarrage
-def get_merge_urls():
-    return [
-        path(
-            template.get_merge_url(),
-            views.TemplateMergeView.as_view(),
-            {"slug": template.slug},
-            name=f"{template.slug}-merge",
-        )
-        for template in DocxTemplate.objects.all()
-    ]
+if get_setting("async_merge_view", False):
+    merge_view = views.AsyncTemplateMergeView.as_view()
+else:
+    merge_view = views.TemplateMergeView.as_view()
 
 
 urlpatterns = [
@@ -28,6 +20,14 @@ urlpatterns = [
     path("templates/create", views.TemplateCreateView.as_view(), name="create"),
     path("templates/update/<slug>", views.TemplateUpdateView.as_view(), name="update"),
     path("templates/delete/<slug>", views.TemplateDeletelView.as_view(), name="delete"),
+    # url arguments are resolved by routing.router against the template DataSource
+    path("templates/merge/<slug>", merge_view, name="merge"),
+    path("templates/merge/<slug>/<path:url_args>", merge_view, name="merge"),
+    path(
+        "templates/bulk/<slug>",
+        views.TemplateBulkMergeView.as_view(),
+        name="bulk-merge",
+    ),
     path(
         "templates/example/<slug>",
         views.TemplateExampleMergeView.as_view(),
@@ -38,10 +38,16 @@ urlpatterns = [
         views.TemplateExampleMergeView.as_view(),
         name="merge-example",
     ),
+    path("jobs/<uuid:pk>", views.MergeJobStatusView.as_view(), name="job-status"),
+    path(
+        "jobs/<uuid:pk>/download",
+        views.MergeJobDownloadView.as_view(),
+        name="job-download",
+    ),
     path("sources", views.DataSourceListView.as_view(), name="data_source_list"),
     path(
         "sources/detail/<slug>",
         views.DataSourceDetailView.as_view(),
         name="data_source",
     ),
-] + get_merge_urls()
+]
@@ -1,24 +1,153 @@
+import datetime
+import decimal
+import hashlib
+from io import BytesIO
+import itertools
+import json
 from pydoc import locate
+import tempfile
+import uuid
+import zipfile
+
 from django.conf import settings
 
 
+def get_setting(name, default=None):
+    """Return an option from settings.DJANGO_DOCX_TEMPLATES, or default if it is not
+    set."""
+    options = getattr(settings, "DJANGO_DOCX_TEMPLATES", None) or {}
+    return options.get(name, default)
+
+
+# DataSource classes resolved so far, by class path
+_data_source_classes = dict()
+
+
+def get_data_source_class(class_path):
+    """Return the DataSource class of class_path. Classes are resolved once per
+    process, later calls are a dict lookup."""
+    data_source_class = _data_source_classes.get(class_path)
+    if data_source_class is None:
+        data_source_class = locate(class_path) if class_path else None
+        if not data_source_class:
+            raise KeyError(f"Unknow DataSource {class_path}")
+        _data_source_classes[class_path] = data_source_class
+    return data_source_class
+
+
 def import_from_string(class_path):
     """Return an existing datasource according to the given path.
     You don't need to list the datasource in your settings to be valid (TODO: to be
     confirmed)"""
-    data_source_class = locate(class_path)
-    if not data_source_class:
-        raise KeyError(f"Unknow DataSource {class_path}")
+    data_source_class = get_data_source_class(class_path)
     data_source = data_source_class(class_path)
     return data_source
 
 
+def load_data_sources():
+    """Resolve all datasources listed in the settings. Return the list of class paths
+    that can't be resolved."""
+    unknown = []
+    for class_path in get_setting("data_sources", []):
+        try:
+            get_data_source_class(class_path)
+        except KeyError:
+            unknown.append(class_path)
+    return unknown
+
+
 def get_all_data_sources():
     """Return all datasources listed in the settings."""
     sources = settings.DJANGO_DOCX_TEMPLATES["data_sources"]
     return [import_from_string(source) for source in sources]
 
 
+def chunked(iterable, size: int):
+    """Yield lists of at most size items from iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ZipStream:
+    """Write-only file object used as output of a zipfile.ZipFile. It keeps what has
+    been written until pop() is called, so the archive can be sent while it is built.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def new_document_file():
+    """Return an empty file to write a merged document in. It is kept in memory up to
+    settings.DJANGO_DOCX_TEMPLATES["spool_max_size"] bytes (8 MB by default), then
+    moved to a temporary file on disk, so big documents don't hold the memory of the
+    process while they are downloaded. None keeps every document in memory."""
+    max_size = get_setting("spool_max_size", 8 * 1024 * 1024)
+    if max_size is None:
+        return BytesIO()
+    return tempfile.SpooledTemporaryFile(max_size=max_size)
+
+
+def iter_zip(entries, chunk_size: int = 64 * 1024):
+    """Yield the content of a zip archive, entry by entry.
+
+    Parameters
+    ==========
+    * entries: iterable of (name, file-like object), consumed lazily. Files are
+      closed once written.
+    * chunk_size: size of the blocks read from each file
+
+    Docx files are already compressed, so entries are deflated with the fastest
+    compression level.
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        for name, file in entries:
+            with archive.open(name, "w") as entry:
+                for data in iter(lambda: file.read(chunk_size), b""):
+                    entry.write(data)
+                    yield stream.pop()
+            file.close()
+            yield stream.pop()
+    yield stream.pop()
+
+
+def _json_default(value):
+    if hasattr(value, "get_cache_key"):  # ConverterMixin
+        return value.get_cache_key()
+    if isinstance(value, (datetime.date, datetime.time, decimal.Decimal, uuid.UUID)):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    raise TypeError(f"{type(value).__name__} can't be part of a context digest")
+
+
+def context_digest(context) -> str:
+    """Return a stable hash of a merge context, or None if the context holds values
+    that can't be hashed reliably."""
+    try:
+        data = json.dumps(context, sort_keys=True, default=_json_default)
+    except (TypeError, NotImplementedError):
+        return None
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
 def remove_slash(part: str) -> str:
     """Remove starting and ending slash from a string"""
     if part[0] == "/":
@@ -31,5 +160,5 @@ def remove_slash(part: str) -> str:
 def merge_url_parts(*parts: list[str]) -> str:
     """Join part of the url with / in between. Clean each part to be sure there is no
     double // in the url."""
-    url_parts = [remove_slash(parts[i]) for i in range(len(parts))]
+    url_parts = [remove_slash(parts[i]) for i in range(len(parts)) if parts[i]]
     return "/".join(url_parts)
@@ -1,5 +1,13 @@
+from asgiref.sync import sync_to_async
 from django.contrib import messages
-from django.http import FileResponse
+from django.core.paginator import Paginator
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponseBadRequest,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.views.generic import (
     View,
     TemplateView,
@@ -11,11 +19,15 @@ from django.views.generic import (
 )
 from django.shortcuts import redirect, get_object_or_404
 from django.urls import reverse_lazy, reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 
 
 from .forms import TemplateForm
-from .models import DocxTemplate
-from .utils import import_from_string, get_all_data_sources
+from .metrics import start_metrics
+from .models import DocxTemplate, MergeJob
+from .routing import router
+from .utils import import_from_string, get_all_data_sources, get_setting, iter_zip
 
 
 class TemplateCreateView(CreateView):
@@ -49,18 +61,35 @@ class TemplateListView(ListView):
         return super().get_context_data(**kwargs)
 
 
-class TemplateDetailView(DetailView):
+class ExamplesMixin:
+    """Add a page of the example combinations of the template data source to the
+    context. Combinations are lazy, only the displayed page is computed."""
+
+    examples_paginate_by = 20
+
+    def get_context_data(self, **kwargs):
+        examples = self.object.data_source.get_all_example_combinations()
+        if examples:
+            paginator = Paginator(examples, self.examples_paginate_by)
+            page = paginator.get_page(self.request.GET.get("page"))
+            # each line is (example number, values)
+            kwargs["examples"] = [
+                (number, example.values())
+                for number, example in enumerate(page, start=page.start_index() - 1)
+            ]
+            kwargs["example_headers"] = examples.keys
+            kwargs["examples_page"] = page
+        return super().get_context_data(**kwargs)
+
+
+class TemplateDetailView(ExamplesMixin, DetailView):
     model = DocxTemplate
 
     def get_context_data(self, **kwargs):
         kwargs["base_template"] = "django_docx_template/base.html"
-        examples = self.object.data_source.get_all_example_combinations()
-        kwargs["url_name"] = f"{self.object.slug}-merge"
+        kwargs["url_name"] = "docx_template:merge"
         base_url = reverse("docx_template:base_url")[1:]  # remove leading /
         kwargs["url_merge"] = f'{base_url}{self.object.get_merge_url()}'
-        if examples:
-            kwargs["examples"] = [_.values() for _ in examples]
-            kwargs["example_headers"] = examples[0].keys()
         return super().get_context_data(**kwargs)
 
 
@@ -69,20 +98,81 @@ class TemplateDeletelView(DeleteView):
 
     def get_context_data(self, **kwargs):
         kwargs["base_template"] = "django_docx_template/base.html"
-        examples = self.object.data_source.get_all_example_combinations()
-        if examples:
-            kwargs["examples"] = [_.values() for _ in examples]
-            kwargs["example_headers"] = examples[0].keys()
         return super().get_context_data(**kwargs)
 
 
 class TemplateMergeView(View):
+    # context fetched by get_validators, None if it wasn't needed
+    context = None
+    # MergeMetrics started before get_validators, None if they aren't collected
+    metrics = None
+
     def merge(self, template, **kwargs):
-        return template.merge(**kwargs)
+        """Return the document merged with the DataSource kwargs. The context
+        fetched by get_validators isn't fetched again and the merge phases are added
+        to the metrics started by get()."""
+        return template.merge_timed(
+            kwargs=kwargs, context=self.context, metrics=self.metrics
+        )
+
+    def get_merge_kwargs(self, template):
+        """Return the DataSource kwargs read from the url arguments."""
+        slug = template.slug
+        if router.get_data_source_class(slug, template) != template.data_source_class:
+            # the template has been updated by another process
+            router.invalidate(slug)
+        url_args = self.kwargs.get("url_args", "")
+        merge_kwargs = router.resolve(slug, url_args, template)
+        if merge_kwargs is None:
+            raise Http404("Url arguments don't match the template data source.")
+        return merge_kwargs
 
     def get(self, request, *args, **kwargs):
         template = get_object_or_404(DocxTemplate, slug=self.kwargs["slug"])
-        buffer = self.merge(template, **kwargs)
+        template.collect_metrics = self.send_server_timing()
+        merge_kwargs = self.get_merge_kwargs(template)
+        self.metrics = start_metrics(template)
+        if self.metrics is None:
+            validators = self.get_validators(template, merge_kwargs)
+        else:
+            with self.metrics:
+                validators = self.get_validators(template, merge_kwargs)
+            self.metrics.lap("validators")
+        etag, last_modified, self.context = validators
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            buffer = self.merge(template, **merge_kwargs)
+            response = self.get_response(template, buffer)
+        return self.set_validators(response, etag, last_modified)
+
+    def get_validators(self, template, merge_kwargs):
+        """Return (etag, last_modified, context) used to answer conditional requests
+        without rendering the document.
+
+        The last modification timestamp comes from DataSource.get_last_modified, if
+        it is unknown the context is fetched to build an ETag, and returned so the
+        merge doesn't fetch it again.
+        """
+        last_modified = template.get_last_modified(**merge_kwargs)
+        if last_modified is not None:
+            return None, int(last_modified), None
+        context = template.data_source.get_context_data(**merge_kwargs)
+        return template.get_etag(context), None, context
+
+    def set_validators(self, response, etag, last_modified):
+        if etag is not None:
+            response.headers.setdefault("ETag", etag)
+        if last_modified is not None:
+            response.headers.setdefault("Last-Modified", http_date(last_modified))
+        return response
+
+    def send_server_timing(self) -> bool:
+        """Whether responses have a Server-Timing header with the merge timings."""
+        return get_setting("server_timing", False)
+
+    def get_response(self, template, buffer):
         content_type = (
             "application/vnd.openxmlformats-officedocument.wordprocessingml.document;"
             "charset=utf-8"
@@ -90,17 +180,137 @@ class TemplateMergeView(View):
         # TODO use context data to improve filenaming
         filename = template.name.replace(" ", "_")
         filename += ".docx"
-        return FileResponse(
+        response = FileResponse(
             buffer, content_type=content_type, as_attachment=True, filename=filename
         )
+        if template.collect_metrics and template.last_merge_metrics is not None:
+            # validators include the context fetch when the ETag is built from it
+            server_timing = template.last_merge_metrics.get_server_timing()
+            response["Server-Timing"] = server_timing
+        return response
+
+
+class AsyncTemplateMergeView(TemplateMergeView):
+    """Async version of TemplateMergeView for ASGI deployments: database queries use
+    the async ORM and the render runs in a thread pool."""
+
+    async def merge(self, template, **kwargs):
+        return await template.amerge_timed(
+            kwargs=kwargs, context=self.context, metrics=self.metrics
+        )
+
+    async def aget_validators(self, template, merge_kwargs):
+        """Async version of get_validators(), the context is fetched with
+        DataSource.aget_context_data() and the ETag is computed out of the event
+        loop."""
+        last_modified = await sync_to_async(template.get_last_modified)(**merge_kwargs)
+        if last_modified is not None:
+            return None, int(last_modified), None
+        context = await template.data_source.aget_context_data(**merge_kwargs)
+        # the ETag can read image files and storage metadata
+        etag = await sync_to_async(template.get_etag)(context)
+        return etag, None, context
+
+    async def get(self, request, *args, **kwargs):
+        try:
+            template = await DocxTemplate.objects.aget(slug=self.kwargs["slug"])
+        except DocxTemplate.DoesNotExist:
+            raise Http404("No DocxTemplate matches the given query.")
+        template.collect_metrics = self.send_server_timing()
+        merge_kwargs = await sync_to_async(self.get_merge_kwargs)(template)
+        self.metrics = start_metrics(template)
+        etag, last_modified, self.context = await self.aget_validators(
+            template, merge_kwargs
+        )
+        if self.metrics is not None:
+            self.metrics.lap("validators")
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            buffer = await self.merge(template, **merge_kwargs)
+            response = self.get_response(template, buffer)
+        return self.set_validators(response, etag, last_modified)
+
+
+class TemplateBulkMergeView(View):
+    """Download a zip of the documents merged for several url kwargs, read from the
+    query string (see DataSource.get_bulk_url_kwargs). The zip is streamed while
+    documents are merged, it is never fully held in memory."""
+
+    def get_entry_name(self, template, url_kwargs):
+        return template.get_document_name(url_kwargs)
+
+    def get(self, request, *args, **kwargs):
+        template = get_object_or_404(DocxTemplate, slug=self.kwargs["slug"])
+        try:
+            url_kwargs_list = template.data_source.get_bulk_url_kwargs(request.GET)
+        except ValueError as exc:
+            return HttpResponseBadRequest(str(exc))
+        entries = (
+            (self.get_entry_name(template, url_kwargs), buffer)
+            for url_kwargs, buffer in template.merge_many(url_kwargs_list)
+            if buffer is not None
+        )
+        response = StreamingHttpResponse(
+            iter_zip(entries), content_type="application/zip"
+        )
+        filename = template.name.replace(" ", "_")
+        response["Content-Disposition"] = f'attachment; filename="{filename}.zip"'
+        return response
 
 
 class TemplateExampleMergeView(TemplateMergeView):
+    def get_merge_kwargs(self, template):
+        return self.kwargs
+
+    def get_validators(self, template, merge_kwargs):
+        # random examples can't be validated
+        return None, None, None
+
     def merge(self, template, **kwargs):
         example_number = kwargs.get("example_number", None)
         return template.merge_example(example_number=example_number)
 
 
+class MergeJobStatusView(View):
+    """Status of a background merge (see DocxTemplate.enqueue_merge), as JSON, with
+    the download url once the job is done."""
+
+    def get(self, request, *args, **kwargs):
+        job = get_object_or_404(MergeJob, pk=self.kwargs["pk"])
+        data = {
+            "id": str(job.pk),
+            "status": job.status,
+            "created_at": job.created_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+            "skipped": job.skipped,
+        }
+        if job.status == MergeJob.DONE:
+            data["download_url"] = reverse(
+                "docx_template:job-download", kwargs={"pk": job.pk}
+            )
+        return JsonResponse(data)
+
+
+class MergeJobDownloadView(View):
+    def get(self, request, *args, **kwargs):
+        job = get_object_or_404(MergeJob, pk=self.kwargs["pk"], status=MergeJob.DONE)
+        content_type = "application/zip"
+        if not job.bulk:
+            content_type = (
+                "application/vnd.openxmlformats-officedocument"
+                ".wordprocessingml.document"
+            )
+        return FileResponse(
+            job.result.open("rb"),
+            content_type=content_type,
+            as_attachment=True,
+            filename=job.get_file_name(),
+        )
+
+
 class DataSourceListView(TemplateView):
     template_name = "django_docx_template/datasource_list.html"
 
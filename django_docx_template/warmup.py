@@ -0,0 +1,104 @@
+"""Warm-up of templates, to run before a server forks its workers.
+
+Each template is prepared as by its first merge: DataSource class resolved, merge
+route loaded, docx parsed into the template cache and Jinja templates of its parts
+compiled. Workers forked afterwards share that memory (copy-on-write) and their first
+merges are as fast as the next ones.
+
+Run it with the docx_warmup command, from a server hook (gunicorn --preload and
+when_ready for example), or when the app is ready with
+settings.DJANGO_DOCX_TEMPLATES["preload_templates"] = True.
+"""
+import gc
+import logging
+from time import perf_counter
+import tracemalloc
+import warnings
+
+from django.db import DatabaseError
+
+from .engine import DocxEngine
+from .executors import in_worker
+from .routing import router
+
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up(template) -> None:
+    """Prepare template for its next merges (see module docstring)."""
+    template.data_source  # resolves the DataSource class
+    router.get_route(template.slug, template)
+    cached = template._get_cached_template()
+    # compiling doesn't modify the document, it works on the cached one
+    docx_engine = DocxEngine(template.docx, compiled=cached.compiled)
+    docx_engine.docx = cached.document
+    docx_engine.compile()
+
+
+def preload(slugs=None, measure_memory=False) -> list:
+    """Warm up the templates of slugs, or all of them.
+
+    Return a report per template, a dict of slug, seconds, memory (bytes allocated
+    while warming up, only when measure_memory is set as tracing allocations is slow)
+    and error (None, or the exception message of a template that can't be loaded).
+    """
+    from .models import DocxTemplate
+
+    templates = DocxTemplate.objects.all()
+    if slugs:
+        templates = templates.filter(slug__in=slugs)
+    tracing = measure_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    reports = []
+    try:
+        for template in templates:
+            memory = tracemalloc.get_traced_memory()[0] if measure_memory else None
+            started = perf_counter()
+            error = None
+            try:
+                warm_up(template)
+            except Exception as exc:
+                error = f"{type(exc).__name__}: {exc}"
+            report = {
+                "slug": template.slug,
+                "seconds": perf_counter() - started,
+                "memory": None,
+                "error": error,
+            }
+            if measure_memory:
+                report["memory"] = tracemalloc.get_traced_memory()[0] - memory
+            reports.append(report)
+    finally:
+        if tracing:
+            tracemalloc.stop()
+    return reports
+
+
+def preload_on_ready() -> None:
+    """Preload every template when the app is ready, then move the loaded objects
+    out of the garbage collector reach, so collections in forked workers don't touch
+    (and copy) their memory pages. Errors of the database (not migrated yet, not
+    reachable) are ignored: the templates are then loaded on their first merge.
+
+    Worker processes of executors.ProcessExecutor don't preload: spawned ones set up
+    Django again and only load the templates they render."""
+    if in_worker():
+        return
+    try:
+        with warnings.catch_warnings():
+            # the query is intended, the app is ready and templates are opt-in
+            warnings.filterwarnings(
+                "ignore", message="Accessing the database during app initialization"
+            )
+            reports = preload()
+    except DatabaseError as exc:
+        logger.warning("Templates not preloaded: %s", exc)
+        return
+    for report in reports:
+        if report["error"]:
+            logger.warning(
+                "Template %s not preloaded: %s", report["slug"], report["error"]
+            )
+    gc.freeze()